@@ -0,0 +1,215 @@
+import pandas as pd
+import numpy as np
+import multiprocessing
+import argparse
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from synthetic_ukb import generate
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+code_dirs = [os.path.join(benchmark_dir, '..', 'Dataset'), os.path.join(benchmark_dir, '..', 'Model')]
+baselines_file = os.path.join(benchmark_dir, 'baselines.json')
+# A benchmark fails when its throughput drops or its peak memory grows by more than this share of the baseline
+default_threshold = 0.25
+# Quick steps are repeated until they ran this long, a single run of a few milliseconds is mostly noise
+min_run_time = 1.0
+
+def remove_caches(data_dir):
+    for path in [os.path.join(data_dir, 'Dataset', 'field_catalog.json'),
+                 os.path.join(data_dir, 'biobank', 'hesin_diag_aggregates.npz')]:
+        if os.path.exists(path):
+            os.remove(path)
+
+def load_cohort_frame():
+    from utils import feature_to_code, read_table
+    df = read_table('Dataset/dataset_all.csv', index_col=0)
+    return df[df[feature_to_code('Sex')] != 1]
+
+# Every benchmark prepares its input and returns the timed step and the number of rows it processes
+
+def bench_create_dataset(data_dir):
+    os.chdir(os.path.join(data_dir, 'Dataset'))
+    from parse_database import UKBDatasetCreator, requested_features
+    creator = UKBDatasetCreator(requested_features)
+    def run():
+        creator.create_dataset()
+        return len(creator.df)
+    return run
+
+def bench_stream_dataset(data_dir):
+    os.chdir(os.path.join(data_dir, 'Dataset'))
+    from parse_database import UKBDatasetCreator, requested_features
+    creator = UKBDatasetCreator(requested_features)
+    return lambda: creator.stream_dataset('benchmark_dataset.csv')
+
+def bench_create_cohort(data_dir):
+    os.chdir(data_dir)
+    from create_cohort import Cohort
+    num_rows = len(pd.read_csv('Dataset/dataset_all.csv', usecols=['eid']))
+    def run():
+        Cohort().create_cohort()
+        return num_rows
+    return run
+
+def bench_preprocess_cat_features(data_dir):
+    os.chdir(data_dir)
+    from features_preprocess import preprocess_cat_features
+    df = load_cohort_frame()
+    def run():
+        preprocess_cat_features(df.copy())
+        return len(df)
+    return run
+
+def bench_code_to_feature(data_dir):
+    os.chdir(data_dir)
+    from utils import code_to_feature, codes_to_features, init
+    init()
+    columns = list(pd.read_csv('Dataset/dataset_all.csv', nrows=0, index_col=0).columns) * 100
+    def run():
+        codes_to_features(columns)
+        for column in columns[:len(columns) // 10]:
+            code_to_feature(column)
+        return len(columns) + len(columns) // 10
+    return run
+
+def bench_train_models(data_dir):
+    os.chdir(data_dir)
+    from sklearn.model_selection import train_test_split
+    from sklearn.impute import SimpleImputer
+    from model_selection import ModelSelector
+    from create_cohort import Cohort
+    cohort = Cohort()
+    cohort.create_cohort()
+    cohort.split_x_y()
+    X = pd.DataFrame(SimpleImputer(strategy='mean').fit_transform(cohort.X), columns=cohort.X.columns)
+    X_train, X_test, y_train, y_test = train_test_split(X, cohort.y, test_size=0.3, shuffle=True, random_state=42)
+    def run():
+        ModelSelector().train_models(X_train, y_train, X_test, y_test)
+        return len(X_train)
+    return run
+
+benchmarks = {
+    'create_dataset': bench_create_dataset,
+    'stream_dataset': bench_stream_dataset,
+    'create_cohort': bench_create_cohort,
+    'preprocess_cat_features': bench_preprocess_cat_features,
+    'code_to_feature': bench_code_to_feature,
+    'train_models': bench_train_models,
+}
+
+def add_code_dirs():
+    for path in code_dirs:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+def prepare_dataset(data_dir):
+    # The model benchmarks read the merged dataset, it is created once outside of the measurements
+    add_code_dirs()
+    os.chdir(os.path.join(data_dir, 'Dataset'))
+    from parse_database import UKBDatasetCreator, requested_features
+    UKBDatasetCreator(requested_features).stream_dataset()
+
+def in_fresh_process(func, *args):
+    # A fresh process per run, the peak RSS and the imports of one benchmark do not leak into the next
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+def run_benchmark(name, data_dir):
+    add_code_dirs()
+    # Every benchmark runs in a fresh process, so the peak RSS of the process is the peak of the benchmark
+    from instrumentation import peak_rss_mb
+    remove_caches(data_dir)
+    run = benchmarks[name](data_dir)
+
+    rows = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    while rows == 0 or time.perf_counter() - start < min_run_time:
+        # Every iteration starts cold, without the field catalog and the HES aggregates of the previous one
+        remove_caches(data_dir)
+        rows += run()
+    wall_time = time.perf_counter() - start
+    return {
+        'wall_time': wall_time,
+        'cpu_time': time.process_time() - cpu_start,
+        'rows': int(rows),
+        'rows_per_s': rows / wall_time,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def measure(name, data_dir, repeat):
+    runs = [in_fresh_process(run_benchmark, name, data_dir) for _ in range(repeat)]
+    best = max(runs, key=lambda run: run['rows_per_s'])
+    if best['peak_rss_mb'] is not None:
+        best['peak_rss_mb'] = min(run['peak_rss_mb'] for run in runs)
+    return best
+
+def load_baselines():
+    if not os.path.exists(baselines_file):
+        return {}
+    with open(baselines_file, 'r') as f:
+        return json.load(f)
+
+def save_baselines(baselines):
+    with open(baselines_file, 'w') as f:
+        json.dump(baselines, f, indent=4, sort_keys=True)
+
+def compare(result, baseline, threshold):
+    if baseline is None:
+        return 'no baseline'
+    problems = []
+    if result['rows_per_s'] < baseline['rows_per_s'] * (1 - threshold):
+        problems.append(f"throughput {result['rows_per_s'] / baseline['rows_per_s'] - 1:+.0%}")
+    # No peak RSS on Windows, only the throughput is compared there
+    if None not in (result['peak_rss_mb'], baseline['peak_rss_mb']) and result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + threshold):
+        problems.append(f"peak memory {result['peak_rss_mb'] / baseline['peak_rss_mb'] - 1:+.0%}")
+    return 'REGRESSION ' + ', '.join(problems) if problems else 'ok'
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic UKB data against stored baselines")
+    parser.add_argument('benchmarks', nargs='*', default=list(benchmarks), choices=list(benchmarks))
+    parser.add_argument('--participants', type=int, default=10000)
+    parser.add_argument('--data-dir', help="Reuse synthetic data generated with synthetic_ukb.py")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=default_threshold)
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as the new baselines")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='ukb_benchmark_')
+    try:
+        if args.data_dir is None:
+            generate(data_dir, args.participants)
+        in_fresh_process(prepare_dataset, data_dir)
+
+        # Baselines depend on the machine and the scale, they are kept per participant count
+        baselines = load_baselines()
+        scale_baselines = baselines.setdefault(str(args.participants), {})
+        results = {}
+        for name in args.benchmarks:
+            print(f"Running {name}")
+            results[name] = measure(name, data_dir, args.repeat)
+            results[name]['status'] = compare(results[name], scale_baselines.get(name), args.threshold)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    table = pd.DataFrame(results).T[['rows', 'wall_time', 'cpu_time', 'rows_per_s', 'peak_rss_mb', 'status']]
+    print(table.to_string(float_format=lambda value: f'{value:.2f}'))
+
+    if args.save_baseline:
+        for name, result in results.items():
+            scale_baselines[name] = {'rows_per_s': result['rows_per_s'], 'peak_rss_mb': result['peak_rss_mb']}
+        save_baselines(baselines)
+        print(f"Saved the baselines to {baselines_file}")
+    elif any(result['status'].startswith('REGRESSION') for result in results.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import pandas as pd
+import numpy as np
+import argparse
+import os
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+features_csv = os.path.join(code_dir, 'Dataset', 'features_data.csv')
+
+main_ukb_file = "ukb672220.csv"
+second_ukb_file = "ukb673316.csv"
+third_ukb_file = "ukb673540.csv"
+
+sex_code = 31
+year_of_birth_code = 34
+age_at_recruitment_code = 21022
+menarche_code = 2714
+menopause_code = 3581
+endo_source_code = 132123
+cancer_code = 40006
+operations_code = 41272
+
+# Shares of the participants with a value, close to the UKB release the project was built on
+female_share = 0.54
+first_occurrence_share = 0.04
+endo_share = 0.03
+cancer_share = 0.08
+operations_share = 0.3
+numeric_share = 0.6
+extra_field_share = 0.2
+# Participants that withdrew before a later basket was released are missing from it
+later_basket_share = 0.97
+
+cancer_codes = ['C50', 'C509', 'C56', 'C55', 'C53', 'C43', 'C449', 'C18', 'C61', 'D05', 'D06']
+operation_codes = ['R17', 'R171', 'R182', 'Q07', 'Q073', 'H01', 'W37', 'J18', 'M45', 'Q38']
+hes_codes = ['N800', 'N801', 'K580', 'C509', 'O800', 'O821', 'M545', 'I10', 'E039', 'Z370', 'R104', 'D509']
+hes_arrays = 3
+cancer_instances = 4
+operation_arrays = 8
+
+def field_codes():
+    features = pd.read_csv(features_csv, index_col=0)
+    return list(dict.fromkeys(features['UKB Number'].astype(int)))
+
+def dates(rng, n, share, start='1995-01-01', days=9000):
+    values = (pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, n), 'D')).strftime('%Y-%m-%d').to_numpy(object)
+    values[rng.random(n) >= share] = np.nan
+    return values
+
+def codes(rng, n, choices, share):
+    values = rng.choice(choices, n).astype(object)
+    values[rng.random(n) >= share] = np.nan
+    return values
+
+def field_columns(rng, code, n):
+    # Returns {column: values}, the coded fields have several instances / array entries like in the showcase
+    if code == sex_code:
+        return {f'{code}-0.0': (rng.random(n) >= female_share).astype(np.int64)}
+    if code == year_of_birth_code:
+        return {f'{code}-0.0': rng.integers(1937, 1971, n)}
+    if code == age_at_recruitment_code:
+        return {f'{code}-0.0': rng.integers(40, 71, n)}
+    if code in (menarche_code, menopause_code):
+        ages = rng.integers(9, 18, n) if code == menarche_code else rng.integers(40, 60, n)
+        values = np.where(rng.random(n) < 0.05, rng.choice([-1, -3], n), ages).astype(float)
+        values[rng.random(n) >= (0.95 if code == menarche_code else 0.45)] = np.nan
+        return {f'{code}-0.0': values}
+    if code == cancer_code:
+        return {f'{code}-{instance}.0': codes(rng, n, cancer_codes, cancer_share / (instance + 1))
+                for instance in range(cancer_instances)}
+    if code == operations_code:
+        return {f'{code}-0.{array}': codes(rng, n, operation_codes, operations_share / (array + 1))
+                for array in range(operation_arrays)}
+    if 130000 <= code < 133000:
+        # First occurrences come in pairs, the even field is the "Date ... first reported" and the odd one its source
+        share = endo_share if code in (endo_source_code - 1, endo_source_code) else first_occurrence_share
+        if code % 2 == 0:
+            return {f'{code}-0.0': dates(rng, n, share)}
+        values = rng.choice([20., 30., 40., 50.], n)
+        values[rng.random(n) >= share] = np.nan
+        return {f'{code}-0.0': values}
+    values = rng.normal(10, 3, n).round(2)
+    values[rng.random(n) >= numeric_share] = np.nan
+    return {f'{code}-0.0': values}
+
+def basket_fields(codes_list):
+    # The last basket holds the health outcomes, the second one a slice of the rest
+    third = [code for code in codes_list if code >= 130000 or code in (cancer_code, operations_code)]
+    rest = [code for code in codes_list if code not in third]
+    second = rest[len(rest) * 2 // 3:]
+    main = [sex_code] + [code for code in rest[:len(rest) * 2 // 3] if code != sex_code]
+    return {main_ukb_file: main, second_ukb_file: [code for code in second if code != sex_code], third_ukb_file: third}
+
+def write_basket(rng, path, codes_list, eids, extra_fields, start_field):
+    columns = {'eid': eids}
+    for code in codes_list:
+        columns.update(field_columns(rng, code, len(eids)))
+    for field in range(start_field, start_field + extra_fields):
+        # Fields nobody requested, they only widen the file like the real baskets
+        values = rng.normal(0, 1, len(eids)).round(3)
+        values[rng.random(len(eids)) >= extra_field_share] = np.nan
+        columns[f'{field}-0.0'] = values
+    pd.DataFrame(columns).to_csv(path, index=False)
+    fields_path = os.path.join(os.path.dirname(path), 'fields' + os.path.basename(path)[3:-4] + '.ukb')
+    with open(fields_path, 'w') as f:
+        f.write('\n'.join(['eid'] + [str(code) for code in codes_list]))
+
+def array_index(counts):
+    return np.concatenate([np.arange(count) for count in counts]) if len(counts) else np.zeros(0, dtype=int)
+
+def write_hes(rng, out_dir, eids):
+    # Every participant has a Poisson number of episodes, each with a few diagnoses
+    episodes = rng.poisson(2.5, len(eids))
+    episode_eids = np.repeat(eids, episodes)
+    ins_index = array_index(episodes)
+    episode_dates = (pd.Timestamp('1997-01-01') + pd.to_timedelta(rng.integers(0, 9000, len(episode_eids)), 'D')).strftime('%d/%m/%Y')
+    pd.DataFrame({
+        'eid': episode_eids,
+        'ins_index': ins_index,
+        'epistart': episode_dates,
+        'admidate': episode_dates,
+    }).to_csv(os.path.join(out_dir, 'hesin.txt'), sep='\t', index=False)
+
+    diagnoses = rng.integers(1, hes_arrays + 1, len(episode_eids))
+    arr_index = array_index(diagnoses)
+    pd.DataFrame({
+        'eid': np.repeat(episode_eids, diagnoses),
+        'ins_index': np.repeat(ins_index, diagnoses),
+        'arr_index': arr_index,
+        'level': np.where(arr_index == 0, 1, 2),
+        'diag_icd9': np.nan,
+        'diag_icd9_nb': np.nan,
+        'diag_icd10': codes(rng, diagnoses.sum(), hes_codes, 0.95),
+        'diag_icd10_nb': np.nan,
+    }).to_csv(os.path.join(out_dir, 'hesin_diag.txt'), sep='\t', index=False)
+
+def generate(out_dir, participants=10000, extra_fields=200, shuffle_eids=False, seed=0):
+    # Writes the layout of the Code directory, Dataset/biobank for the baskets and biobank for the HES tables
+    rng = np.random.default_rng(seed)
+    basket_dir = os.path.join(out_dir, 'Dataset', 'biobank')
+    hes_dir = os.path.join(out_dir, 'biobank')
+    os.makedirs(basket_dir, exist_ok=True)
+    os.makedirs(hes_dir, exist_ok=True)
+
+    eids = np.sort(rng.choice(np.arange(1000000, 6000000), participants, replace=False))
+    start_field = 200000
+    for i, (name, codes_list) in enumerate(basket_fields(field_codes()).items()):
+        basket_eids = eids if i == 0 else eids[rng.random(participants) < later_basket_share]
+        if shuffle_eids:
+            basket_eids = rng.permutation(basket_eids)
+        write_basket(rng, os.path.join(basket_dir, name), codes_list, basket_eids, extra_fields if i == 0 else extra_fields // 4, start_field)
+        start_field += extra_fields
+
+    write_hes(rng, hes_dir, eids)
+    pd.read_csv(features_csv, index_col=0).to_pickle(os.path.join(out_dir, 'Dataset', 'features_data.csv.pkl'))
+    print(f"Generated {participants} synthetic participants in {out_dir}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate UKB shaped synthetic baskets and HES tables")
+    parser.add_argument('out_dir')
+    parser.add_argument('--participants', type=int, default=10000)
+    parser.add_argument('--extra-fields', type=int, default=200)
+    parser.add_argument('--shuffle-eids', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.out_dir, args.participants, args.extra_fields, args.shuffle_eids, args.seed)
+
+if __name__ == "__main__":
+    main()
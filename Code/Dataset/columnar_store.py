@@ -0,0 +1,74 @@
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import os
+
+from field_catalog import infer_dtypes
+
+store_chunk_size = 100000
+# Key of the Parquet footer metadata that records whether the rows are sorted by unique eids
+eid_sorted_key = b'eid_sorted'
+
+arrow_types = {
+    'int64': pa.int64(),
+    'float64': pa.float64(),
+    'object': pa.string(),
+}
+
+def parquet_path(path):
+    return os.path.splitext(path)[0] + '.parquet'
+
+def has_fresh_parquet(path):
+    store_path = parquet_path(path)
+    if not os.path.exists(store_path):
+        return False
+    # The csv may have been deleted after the conversion to save disk space
+    return not os.path.exists(path) or os.path.getmtime(store_path) >= os.path.getmtime(path)
+
+def parquet_eid_sorted(path):
+    # None for stores written before the flag was recorded, their readers scan the eids instead
+    metadata = pq.read_metadata(parquet_path(path)).metadata or {}
+    if eid_sorted_key not in metadata:
+        return None
+    return metadata[eid_sorted_key] == b'true'
+
+def convert_to_parquet(path, sep=',', index_col=None, chunk_size=store_chunk_size):
+    store_path = parquet_path(path)
+    dtypes = infer_dtypes(path, sep=sep)
+    if index_col is not None:
+        dtypes.pop(list(dtypes)[index_col])
+    schema = pa.schema([(column, arrow_types[dtype]) for column, dtype in dtypes.items()])
+
+    print(f"Converting {path} to {store_path}")
+    last_eid = None
+    is_sorted = True
+    num_rows = 0
+    # Every chunk is written as its own row group, the eid min/max statistics of the
+    # row groups is what lets the readers skip the participants they do not need
+    with pq.ParquetWriter(store_path, schema) as writer:
+        with pd.read_csv(path, sep=sep, index_col=index_col, dtype=dtypes, chunksize=chunk_size) as reader:
+            for chunk in reader:
+                chunk = chunk.sort_values('eid', kind='stable')
+                eids = chunk['eid'].to_numpy()
+                if len(eids) != 0:
+                    if (eids[1:] <= eids[:-1]).any() or (last_eid is not None and eids[0] <= last_eid):
+                        is_sorted = False
+                    last_eid = eids[-1]
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False), row_group_size=chunk_size)
+                num_rows += len(chunk)
+            # An unsorted file is kept in its order, sorting it would need the whole table in memory. The flag
+            # tells the readers to join it with a hash join instead of a merge join
+            writer.add_key_value_metadata({eid_sorted_key: b'true' if is_sorted else b'false'})
+
+    if not is_sorted:
+        print(f"{path} is not sorted by eid, its store is joined with a hash join")
+    print(f"Wrote {num_rows} rows to {store_path}")
+
+def read_parquet(path, columns=None, eids=None):
+    filters = [('eid', 'in', list(eids))] if eids is not None else None
+    return pd.read_parquet(parquet_path(path), columns=columns, filters=filters)
+
+def iter_parquet(path, columns, chunk_size=store_chunk_size):
+    parquet_file = pq.ParquetFile(parquet_path(path))
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+        yield batch.to_pandas()
@@ -0,0 +1,90 @@
+import numpy as np
+import json
+import os
+
+def manifest_path(db_path):
+    return os.path.splitext(db_path)[0] + '_manifest.json'
+
+def file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+def read_withdrawals(path):
+    # UKB withdrawal files are a single column of eids without a header
+    if path is None:
+        return np.zeros(0, dtype=np.int64)
+    with open(path, 'r') as f:
+        return np.array([int(line) for line in f if line.strip()], dtype=np.int64)
+
+class DatasetDelta():
+    def __init__(self, added_columns, removed_columns, reread_columns, changed_baskets, new_withdrawn):
+        self.added_columns = added_columns
+        self.removed_columns = removed_columns
+        # Added columns and the columns of baskets that changed or that a column moved to, read for every participant
+        self.reread_columns = reread_columns
+        self.changed_baskets = changed_baskets
+        self.new_withdrawn = new_withdrawn
+
+    def is_empty(self):
+        return (len(self.reread_columns) == 0 and len(self.removed_columns) == 0 and
+                len(self.changed_baskets) == 0 and len(self.new_withdrawn) == 0)
+
+    def describe(self):
+        return (f"{len(self.added_columns)} new columns, {len(self.removed_columns)} removed columns, "
+                f"{len(self.reread_columns)} columns to read, {len(self.changed_baskets)} new or changed baskets, "
+                f"{len(self.new_withdrawn)} new withdrawals")
+
+class DatasetManifest():
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.path = manifest_path(db_path)
+        # Column -> the basket it was read from, basket -> [mtime, size] of the file when it was read
+        self.columns = {}
+        self.baskets = {}
+        self.withdrawn = np.zeros(0, dtype=np.int64)
+        self.num_rows = 0
+        self.dataset = None
+
+    def load(self, require_dataset=True):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r') as f:
+            manifest = json.load(f)
+        self.columns = manifest['columns']
+        self.baskets = {path: tuple(signature) for path, signature in manifest['baskets'].items()}
+        self.withdrawn = np.array(manifest['withdrawn'], dtype=np.int64)
+        self.num_rows = manifest['num_rows']
+        self.dataset = tuple(manifest['dataset'])
+        # A dataset written by other means since the manifest cannot be patched
+        if require_dataset:
+            return os.path.exists(self.db_path) and file_signature(self.db_path) == self.dataset
+        return True
+
+    def update(self, columns, baskets, withdrawn, num_rows):
+        self.columns = dict(columns)
+        self.baskets = dict(baskets)
+        self.withdrawn = np.unique(np.asarray(withdrawn, dtype=np.int64))
+        self.num_rows = num_rows
+        self.dataset = file_signature(self.db_path)
+        return self
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'columns': self.columns,
+                'baskets': {path: list(signature) for path, signature in self.baskets.items()},
+                'withdrawn': self.withdrawn.tolist(),
+                'num_rows': self.num_rows,
+                'dataset': list(self.dataset),
+            }, f)
+        os.replace(tmp_path, self.path)
+
+    def diff(self, columns, baskets, withdrawn):
+        changed_baskets = [path for path, signature in baskets.items() if self.baskets.get(path) != tuple(signature)]
+        added_columns = [column for column in columns if column not in self.columns]
+        removed_columns = [column for column in self.columns if column not in columns]
+        reread_columns = [column for column, path in columns.items()
+                          if column not in self.columns or self.columns[column] != path or path in changed_baskets]
+        new_withdrawn = np.setdiff1d(np.asarray(withdrawn, dtype=np.int64), self.withdrawn)
+        return DatasetDelta(added_columns, removed_columns, reread_columns, changed_baskets, new_withdrawn)
@@ -0,0 +1,142 @@
+import pandas as pd
+import numpy as np
+
+from columnar_store import has_fresh_parquet, iter_parquet, parquet_eid_sorted
+
+eid_scan_chunk_size = 1000000
+
+def eid_array(df):
+    eids = df['eid'].to_numpy()
+    # UKB eids are 7 digit numbers, an int32 index halves the memory of the join keys
+    if len(eids) == 0 or eids.max() <= np.iinfo(np.int32).max:
+        return eids.astype(np.int32, copy=False)
+    return eids.astype(np.int64, copy=False)
+
+def is_eid_sorted(eids):
+    return bool(np.all(eids[1:] > eids[:-1]))
+
+def is_file_eid_sorted(path, sep=','):
+    last_eid = None
+    if has_fresh_parquet(path):
+        # The store records its order when it is written, only older stores are scanned
+        is_sorted = parquet_eid_sorted(path)
+        if is_sorted is not None:
+            return is_sorted
+        chunks = iter_parquet(path, ['eid'], eid_scan_chunk_size)
+    else:
+        chunks = pd.read_csv(path, sep=sep, usecols=['eid'], dtype={'eid': 'int64'}, chunksize=eid_scan_chunk_size)
+    for chunk in chunks:
+        eids = eid_array(chunk)
+        if len(eids) == 0:
+            continue
+        if not is_eid_sorted(eids) or (last_eid is not None and eids[0] <= last_eid):
+            return False
+        last_eid = eids[-1]
+    return True
+
+def merge_join(left, right):
+    # Both sides must be sorted by unique eids, every left row is matched with a binary search on the right keys
+    left_eids = eid_array(left)
+    right_eids = eid_array(right)
+    if len(right_eids) == 0:
+        matched = np.zeros(len(left_eids), dtype=bool)
+        positions = np.zeros(0, dtype=np.intp)
+    else:
+        positions = np.minimum(np.searchsorted(right_eids, left_eids), len(right_eids) - 1)
+        matched = right_eids[positions] == left_eids
+        positions = positions[matched]
+
+    left_part = left.iloc[np.flatnonzero(matched)].reset_index(drop=True)
+    right_part = right.drop(columns=['eid']).iloc[positions].reset_index(drop=True)
+    return pd.concat([left_part, right_part], axis=1)
+
+def hash_join(left, right):
+    return pd.merge(left, right, on='eid', how='inner')
+
+def join_on_eid(left, right):
+    if is_eid_sorted(eid_array(left)) and is_eid_sorted(eid_array(right)):
+        return merge_join(left, right)
+    print("Input is not sorted by eid, falling back to a hash join")
+    return hash_join(left, right)
+
+class SortedEidStream():
+    def __init__(self, chunks, name, columns):
+        self.name = name
+        self.columns = columns
+        self.chunks = iter(chunks)
+        self.buffer = pd.DataFrame(columns=columns)
+        self.last_eid = None
+        self.exhausted = False
+
+    def pull(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            return
+        eids = eid_array(chunk)
+        if len(eids) == 0:
+            return
+        if not is_eid_sorted(eids) or (self.last_eid is not None and eids[0] <= self.last_eid):
+            raise ValueError(f"{self.name} is not sorted by eid anymore, was it changed during the extraction?")
+        self.last_eid = eids[-1]
+        self.buffer = chunk if len(self.buffer) == 0 else pd.concat([self.buffer, chunk])
+
+    def join(self, chunk):
+        if len(chunk) == 0:
+            return merge_join(chunk, self.buffer.iloc[:0])
+        max_eid = chunk['eid'].iloc[-1]
+        while not self.exhausted and (self.last_eid is None or self.last_eid < max_eid):
+            self.pull()
+
+        mask = (self.buffer['eid'] <= max_eid).to_numpy()
+        taken = self.buffer[mask]
+        self.buffer = self.buffer[~mask]
+        return merge_join(chunk, taken)
+
+    def close(self):
+        # Rows past the last main eid are never joined, but the reader must not block on a full queue
+        for _ in self.chunks:
+            pass
+        self.buffer = None
+
+class HashEidStream():
+    def __init__(self, chunks, name, columns):
+        print(f"{name} is not sorted by eid, loading its fields for a hash join")
+        self.name = name
+        chunks = list(chunks)
+        self.table = pd.concat(chunks) if len(chunks) != 0 else pd.DataFrame(columns=columns)
+
+    def join(self, chunk):
+        return hash_join(chunk, self.table)
+
+    def close(self):
+        self.table = None
+
+class EidJoin():
+    def __init__(self, main_chunks, main_sorted):
+        self.main_chunks = main_chunks
+        self.main_sorted = main_sorted
+        self.streams = []
+
+    def add(self, chunks, name, columns, is_sorted):
+        # A sorted stream can only be aligned to a main file that is sorted as well
+        if is_sorted and self.main_sorted:
+            self.streams.append(SortedEidStream(chunks, name, columns))
+        else:
+            self.streams.append(HashEidStream(chunks, name, columns))
+
+    def __iter__(self):
+        last_eid = None
+        try:
+            for chunk in self.main_chunks:
+                if self.main_sorted and len(chunk) != 0:
+                    eids = eid_array(chunk)
+                    if not is_eid_sorted(eids) or (last_eid is not None and eids[0] <= last_eid):
+                        raise ValueError("The main file is not sorted by eid anymore, was it changed during the extraction?")
+                    last_eid = eids[-1]
+                for stream in self.streams:
+                    chunk = stream.join(chunk)
+                yield chunk
+        finally:
+            for stream in self.streams:
+                stream.close()
@@ -0,0 +1,114 @@
+import pandas as pd
+import json
+import csv
+import os
+
+catalog_file = "field_catalog.json"
+dtype_scan_chunk_size = 100000
+
+def field_id(column):
+    return column.split('-')[0]
+
+def infer_dtypes(path, sep=',', chunk_size=dtype_scan_chunk_size):
+    # The whole file is scanned, a column is numeric only if every chunk of it parses as numbers, so fields
+    # that are empty at the top of the file or get strings further down are never read with the wrong dtype
+    is_numeric = {}
+    with pd.read_csv(path, sep=sep, chunksize=chunk_size, low_memory=False) as reader:
+        for chunk in reader:
+            for column in chunk.columns:
+                values = chunk[column]
+                numeric = values.isna().all() or (pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values))
+                is_numeric[column] = is_numeric.get(column, True) and numeric
+
+    dtypes = {}
+    for column, numeric in is_numeric.items():
+        if column == 'eid':
+            dtypes[column] = 'int64'
+        else:
+            # Empty fields are NaN throughout, float64 like the other numeric fields
+            dtypes[column] = 'float64' if numeric else 'object'
+    return dtypes
+
+class FieldCatalog():
+    def __init__(self, ukb_files, catalog_path=catalog_file):
+        # The order of ukb_files decides which file a field is read from when it appears in several of them
+        self.ukb_files = list(ukb_files)
+        self.catalog_path = catalog_path
+        self.files = {}
+        self.columns = {}
+        self.field_columns = {}
+
+    def load(self):
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path, 'r') as f:
+                self.files = json.load(f)
+
+        changed = False
+        for path in self.ukb_files:
+            if not os.path.exists(path):
+                print(f"File {path} does not exist, skipping it in the field catalog")
+                self.files.pop(path, None)
+                continue
+            stat = os.stat(path)
+            entry = self.files.get(path)
+            if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                print(f"Indexing the fields of {path}")
+                self.files[path] = self.index_file(path, stat)
+                changed = True
+
+        if changed:
+            self.save()
+        self.build_lookups()
+        return self
+
+    def index_file(self, path, stat):
+        with open(path, 'r', newline='') as f:
+            header = next(csv.reader(f))
+        dtypes = infer_dtypes(path)
+        return {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'columns': {column: [offset, dtypes[column]] for offset, column in enumerate(header)},
+        }
+
+    def save(self):
+        with open(self.catalog_path, 'w') as f:
+            json.dump(self.files, f)
+
+    def build_lookups(self):
+        self.columns = {}
+        self.field_columns = {}
+        for path in reversed(self.ukb_files):
+            if path not in self.files:
+                continue
+            for column, (offset, dtype) in self.files[path]['columns'].items():
+                self.columns[column] = (path, offset, dtype)
+        for column in self.columns:
+            self.field_columns.setdefault(field_id(column), []).append(column)
+
+    def locate(self, column):
+        entry = self.columns.get(column)
+        return entry[0] if entry is not None else None
+
+    def contains(self, column, path=None):
+        if path is None:
+            return column in self.columns
+        return path in self.files and column in self.files[path]['columns']
+
+    def offset(self, column, path):
+        return self.files[path]['columns'][column][0]
+
+    def dtypes(self, columns, path):
+        file_columns = self.files[path]['columns']
+        return {column: file_columns[column][1] for column in columns}
+
+    def file_property(self, path, name, compute):
+        # Expensive per-file facts are computed on first use and kept until the file changes
+        entry = self.files[path]
+        if name not in entry:
+            entry[name] = compute(path)
+            self.save()
+        return entry[name]
+
+    def columns_of(self, field):
+        return self.field_columns.get(str(field), [])
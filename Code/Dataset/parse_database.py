@@ -1,55 +1,222 @@
 import pandas as pd
+import numpy as np
+import threading
+import argparse
+import queue
+import sys
+import os
+
+# The dtype schema is shared with the Model scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Model'))
+
+from dtype_schema import apply_schema, column_bytes, memory_report, print_memory_report
+from instrumentation import traced, trace_stage, tracer
+from utils import setup_logging
+from long_fields import LongStoreWriter, melt_columns, multi_instance_fields, long_fields_file
+from eid_join import EidJoin, eid_array, is_file_eid_sorted, join_on_eid
+from columnar_store import convert_to_parquet, has_fresh_parquet, read_parquet, iter_parquet, parquet_eid_sorted
+from field_catalog import FieldCatalog
+from dataset_manifest import DatasetManifest, read_withdrawals
 
 features_path = 'features by category in biobank.xlsx'
 headers = ['Feature Name', 'UKB Number', 'idk']
 features_pickle_file = 'features_data.csv.pkl'
 
-main_features_file = "biobank/fields672220.ukb"
-second_features_file = "biobank/fields673316.ukb"
-
 main_ukb_file = "biobank/ukb672220.csv"
 second_ukb_file = "biobank/ukb673316.csv"
 third_ukb_file = "biobank/ukb673540.csv"
+ukb_files = [main_ukb_file, second_ukb_file, third_ukb_file]
+hes_files = ["biobank/hesin_diag.txt", "biobank/hesin.txt"]
+dataset_file = "dataset_all.csv"
 
-class UKBDatasetCreator():
-    df = None
-    eids = []
-    req_features = []
-    fields = []
-    second_fields = []
-    third_fields = []
-    features = []
-    second_features = []
-    third_features = []
-    need_second_dataset = False
-    need_third_dataset = False
-    ukb_path = None
-    num_rows = 0
+stream_chunk_size = 50000
+
+requested_features = [
+    '1369',
+    '1309',
+    '1408',
+    '1349',
+    '1299',
+    '130622',
+    '130624',
+    '130626',
+    '130638',
+    '130694',
+    '130696',
+    '130736',
+    '130746',
+    '131052',
+    '131054',
+    '131638',
+    '131894',
+    '132122',
+    '132123',
+    '132150',
+    '132156',
+    '132157',
+    '132168',
+    '132206',
+    '132234',
+    '132244',
+    '132280',
+    '20433',
+    '20434',
+    '20445',
+    '20446',
+    '20449',
+    '20505',
+    '20510',
+    '20515',
+    '20516',
+    '20519',
+    '20520',
+    '2090',
+    '2100',
+    '21001',
+    '21002',
+    '21022',
+    '21024',
+    '21026',
+    '21045',
+    '21047',
+    '21050',
+    '21062',
+    '21063',
+    '21065',
+    '22127',
+    '23099',
+    '2714',
+    '2724',
+    '2734',
+    '2754',
+    '2774',
+    '2784',
+    '30010',
+    '30020',
+    '30030',
+    '30800',
+    '31',
+    '34',
+    '3591',
+    '3710',
+    '3720',
+    '3839',
+    '3849',
+    '40006',
+    '41272',
+    '6152',
+    '120009',
+    '120016',
+    '120017',
+    '120026',
+    '120028',
+    '120043',
+    '120044',
+    '120114',
+    '6154',
+    '132128',
+    '132106',
+    '132112',
+    '132146',
+    '130736',
+    '131628',
+    '131626',
+    '3581',
+    '3741',
+    '131638',
+    '131640',
+    '131630',
+    '21031',
+    '21045',
+    '40008',
+    '2976',
+    '2754',
+    '2764',
+    '2824',
+    '2794',
+    '2804',
+    '21050',
+    '132124',
+    '132130',
+    '132264',
+    '131604',
+    '132070',
+    '131928',
+    '132162',
+]
+
+class ChunkReader(threading.Thread):
+    def __init__(self, path, fields, dtypes, chunk_size=stream_chunk_size, max_pending=2):
+        super().__init__(daemon=True)
+        self.path = path
+        self.fields = fields
+        self.chunk_size = chunk_size
+        self.dtypes = dtypes
+        # Bounded so a fast reader cannot run ahead of the merge and fill the memory
+        self.chunks = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+    def run(self):
+        try:
+            if has_fresh_parquet(self.path):
+                for chunk in iter_parquet(self.path, self.fields, self.chunk_size):
+                    self.chunks.put(chunk)
+            else:
+                with pd.read_csv(self.path, usecols=self.fields, dtype=self.dtypes, chunksize=self.chunk_size) as reader:
+                    for chunk in reader:
+                        self.chunks.put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.chunks.put(None)
 
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+class UKBDatasetCreator():
     def __init__(self, features, num_rows=10000) -> None:
+        self.df = None
+        self.eids = []
+        # Bytes per column of the frames read, before and after the dtype schema, added up over the reads and chunks
+        self.bytes_before_schema = None
+        self.bytes_after_schema = None
         self.ukb_path = main_ukb_file
         self.req_features = features
         self.num_rows = num_rows
+        self.catalog = FieldCatalog(ukb_files)
+        self.fields = []
+        self.second_fields = []
+        self.third_fields = []
+        self.features = []
+        self.second_features = []
+        self.third_features = []
+        self.need_second_dataset = False
+        self.need_third_dataset = False
+        self.withdrawn = np.zeros(0, dtype=np.int64)
 
+    @traced('UKBDatasetCreator.sort_features', data_arg=None)
     def sort_features(self):
         print("Sorting features by their dataset")
-        with open(main_features_file, 'r') as mff: 
-            main_feats = mff.read().split('\n')
-        with open(second_features_file, 'r') as sff: 
-            sec_feats = sff.read().split('\n')
-
-        for feature in self.req_features:
-            if feature in main_feats:
-                self.features.append(feature)
-            elif feature in sec_feats:
-                self.second_features.append(feature)
-            else:
-                self.third_features.append(feature)
+        self.catalog.load()
+        sorted_features = {path: [] for path in ukb_files}
+        for feature in dict.fromkeys(str(feature) for feature in self.req_features):
+            path = self.catalog.locate(feature + '-0.0')
+            if path is None:
+                print(f"Field {feature}-0.0 was not found. Removing it from fields")
+                continue
+            sorted_features[path].append(feature)
 
-        if len(self.second_features) != 0:
-            self.need_second_dataset = True
-        if len(self.third_features) != 0:
-            self.need_third_dataset = True
+        self.features = sorted_features[main_ukb_file]
+        self.second_features = sorted_features[second_ukb_file]
+        self.third_features = sorted_features[third_ukb_file]
+        self.need_second_dataset = len(self.second_features) != 0
+        self.need_third_dataset = len(self.third_features) != 0
 
     def generate_fields(self) -> None:
         self.sort_features()
@@ -60,174 +227,342 @@ class UKBDatasetCreator():
             self.third_fields = ["eid"] + [(str(third_feature) + '-0.0') for third_feature in self.third_features]
         print(f"Generated fields")
 
+    @traced('UKBDatasetCreator.validate_fields', data_arg=None)
     def validate_fields(self):
-        tmp_df = pd.read_csv(self.ukb_path, nrows=0)
-        for i, field in enumerate(self.fields):
-            if field not in tmp_df.columns:
-                print(f"Field {field} was not found. Removing it from fields")
-                self.fields.pop(i)
-
+        self.fields = self.keep_existing_fields(self.fields, self.ukb_path)
         if self.need_second_dataset:
-            tmp_df = pd.read_csv(second_ukb_file, nrows=0)
-            for i, field in enumerate(self.second_fields):
-                if field not in tmp_df.columns:
-                    print(f"Field {field} was not found. Removing it from second fields")
-                    self.second_fields.pop(i)
-
+            self.second_fields = self.keep_existing_fields(self.second_fields, second_ukb_file)
         if self.need_third_dataset:
-            tmp_df = pd.read_csv(third_ukb_file, nrows=0)
-            for i, field in enumerate(self.third_fields):
-                if field not in tmp_df.columns:
-                    print(f"Field {field} was not found. Removing it from third fields")
-                    self.third_fields.pop(i)
+            self.third_fields = self.keep_existing_fields(self.third_fields, third_ukb_file)
         print("Done validating the fields")
 
+    def keep_existing_fields(self, fields, path):
+        existing = []
+        for field in fields:
+            if self.catalog.contains(field, path):
+                existing.append(field)
+            else:
+                print(f"Field {field} was not found in {path}. Removing it from fields")
+        return existing
+
+    def file_ordered(self, fields, path):
+        return sorted(fields, key=lambda field: self.catalog.offset(field, path))
+
+    @traced('UKBDatasetCreator.read_fields', data_arg=None)
+    def read_fields(self, path, fields):
+        fields = self.file_ordered(fields, path)
+        if has_fresh_parquet(path):
+            df = read_parquet(path, columns=fields)
+        else:
+            df = pd.read_csv(path, usecols=fields, dtype=self.catalog.dtypes(fields, path))
+        return self.compact(df)
+
+    def compact(self, df):
+        compact_df = apply_schema(df)
+        self.add_schema_bytes(column_bytes(df), column_bytes(compact_df))
+        return compact_df
+
+    def add_schema_bytes(self, before, after):
+        if self.bytes_before_schema is None:
+            self.bytes_before_schema, self.bytes_after_schema = before, after
+        else:
+            self.bytes_before_schema = self.bytes_before_schema.add(before, fill_value=0)
+            self.bytes_after_schema = self.bytes_after_schema.add(after, fill_value=0)
+
+    def memory_report(self):
+        if self.bytes_before_schema is None:
+            return None
+        return memory_report(self.bytes_before_schema, self.bytes_after_schema)
+
+    def print_memory_report(self):
+        if self.bytes_before_schema is None:
+            return None
+        return print_memory_report(self.bytes_before_schema, self.bytes_after_schema)
+
+    @traced('UKBDatasetCreator.create_dataset')
     def create_dataset(self):
         print("Creating dataset")
         self.generate_fields()
-        assert self.fields != 1, "There are no fields to get"
+        assert len(self.fields) > 1, "There are no fields to get"
         print("Validating all fields")
         self.validate_fields()
         print("Reading main csv")
-        self.df = pd.read_csv(self.ukb_path, usecols=self.fields)
-        self.eids = self.df["eid"].to_list()
+        self.df = self.read_fields(self.ukb_path, self.fields)
+        self.eids = eid_array(self.df)
         if self.need_second_dataset:
             print("Reading second csv")
-            sec_df = pd.read_csv(second_ukb_file, usecols=self.second_fields)
-            sec_df = sec_df[sec_df['eid'].isin(self.eids)]
-            sec_df.to_csv("second.csv")
+            sec_df = self.read_fields(second_ukb_file, self.second_fields)
             print("Merging datasets by eid")
-            self.df = pd.merge(self.df, sec_df, on='eid', how='inner')
+            with trace_stage('UKBDatasetCreator.join_second', self.df) as stage:
+                self.df = join_on_eid(self.df, sec_df)
+                stage['rows_out'], stage['cols_out'] = self.df.shape
         if self.need_third_dataset:
             print("Reading third csv")
-            third_df = pd.read_csv(third_ukb_file, usecols=self.third_fields)
-            third_df = third_df[third_df['eid'].isin(self.eids)]
-            third_df.to_csv("third.csv")
+            third_df = self.read_fields(third_ukb_file, self.third_fields)
             print("Merging datasets by eid")
-            self.df = pd.merge(self.df, third_df, on='eid', how='inner')
+            with trace_stage('UKBDatasetCreator.join_third', self.df) as stage:
+                self.df = join_on_eid(self.df, third_df)
+                stage['rows_out'], stage['cols_out'] = self.df.shape
+
+    def chunk_reader(self, path, fields, chunk_size):
+        fields = self.file_ordered(fields, path)
+        return ChunkReader(path, fields, self.catalog.dtypes(fields, path), chunk_size)
+
+    def is_eid_sorted(self, path):
+        # A store records its own order and can be rewritten while the csv, which keys the catalog, stays the same
+        is_sorted = parquet_eid_sorted(path) if has_fresh_parquet(path) else None
+        if is_sorted is not None:
+            return is_sorted
+        return self.catalog.file_property(path, 'eid_sorted', is_file_eid_sorted)
+
+    def stream_dataset(self, db_path=dataset_file, chunk_size=stream_chunk_size, withdrawn=None):
+        # Withdrawn participants stay out of every later extraction of the dataset
+        if withdrawn is None:
+            manifest = DatasetManifest(db_path)
+            withdrawn = manifest.withdrawn if manifest.load(require_dataset=False) else np.zeros(0, dtype=np.int64)
+        self.withdrawn = withdrawn
+        with trace_stage('UKBDatasetCreator.stream_dataset') as stage:
+            num_rows, num_cols = self.stream_chunks(db_path, chunk_size, withdrawn)
+            stage['rows_out'], stage['cols_out'] = num_rows, num_cols
+        self.write_manifest(db_path, num_rows, withdrawn)
+        return num_rows
+
+    def stream_chunks(self, db_path, chunk_size, withdrawn):
+        print("Streaming dataset")
+        self.generate_fields()
+        assert len(self.fields) > 1, "There are no fields to get"
+        print("Validating all fields")
+        self.validate_fields()
+
+        # One reader thread per file, all three files are parsed at the same time
+        main_reader = self.chunk_reader(self.ukb_path, self.fields, chunk_size)
+        readers = [main_reader]
+        if self.need_second_dataset:
+            readers.append(self.chunk_reader(second_ukb_file, self.second_fields, chunk_size))
+        if self.need_third_dataset:
+            readers.append(self.chunk_reader(third_ukb_file, self.third_fields, chunk_size))
+        is_sorted = [self.is_eid_sorted(reader.path) for reader in readers]
+        for reader in readers:
+            reader.start()
 
-    def save_dataset(self, db_path="dataset_all.csv"):
+        # UKB baskets are ordered by eid, so each main chunk only needs the matching slice of the other files
+        join = EidJoin(main_reader, is_sorted[0])
+        for reader, reader_sorted in zip(readers[1:], is_sorted[1:]):
+            join.add(reader, reader.path, reader.fields, reader_sorted)
+
+        num_rows = 0
+        num_cols = None
+        write_header = True
+        for chunk in join:
+            if len(withdrawn) != 0:
+                chunk = chunk[~np.isin(chunk['eid'].to_numpy(), withdrawn)]
+            chunk.index = pd.RangeIndex(num_rows, num_rows + len(chunk))
+            # Only measured, the csv is written with the dtypes of the catalog like the rows patched by a refresh
+            self.compact(chunk)
+            with trace_stage('UKBDatasetCreator.write_chunk', chunk):
+                chunk.to_csv(db_path, mode='w' if write_header else 'a', header=write_header)
+            write_header = False
+            num_rows += len(chunk)
+            num_cols = len(chunk.columns)
+            print(f"Wrote {num_rows} rows to {db_path}")
+
+        for reader in readers:
+            reader.join()
+        print(f"Saved dataset to {db_path}")
+        return num_rows, num_cols
+
+    def long_field_columns(self, fields):
+        # Every instance / array column of the fields, grouped by the basket they are read from
+        self.catalog.load()
+        columns = {}
+        for field in fields:
+            field_columns = self.catalog.columns_of(field)
+            if len(field_columns) == 0:
+                print(f"Field {field} was not found. Skipping it in the long store")
+            for column in field_columns:
+                columns.setdefault(self.catalog.locate(column), []).append(column)
+        return columns
+
+    def extract_long_fields(self, fields=multi_instance_fields, path=long_fields_file, chunk_size=stream_chunk_size, exclude_eids=None):
+        with trace_stage('UKBDatasetCreator.extract_long_fields') as stage:
+            writer = LongStoreWriter(path)
+            for basket, columns in self.long_field_columns(fields).items():
+                print(f"Reading {len(columns)} instance columns from {basket}")
+                reader = self.chunk_reader(basket, ['eid'] + columns, chunk_size)
+                reader.start()
+                for chunk in reader:
+                    if exclude_eids is not None and len(exclude_eids) != 0:
+                        chunk = chunk[~np.isin(chunk['eid'].to_numpy(), exclude_eids)]
+                    writer.write(melt_columns(chunk, columns))
+                reader.join()
+            writer.close()
+            stage['rows_out'], stage['cols_out'] = writer.num_rows, 5
+        print(f"Saved {writer.num_rows} field values to {path}")
+
+    def basket_fields(self):
+        baskets = {self.ukb_path: self.fields}
+        if self.need_second_dataset:
+            baskets[second_ukb_file] = self.second_fields
+        if self.need_third_dataset:
+            baskets[third_ukb_file] = self.third_fields
+        return baskets
+
+    def dataset_columns(self):
+        # The columns in the order of a full extraction, with the basket each one is read from
+        columns = {}
+        for path, fields in self.basket_fields().items():
+            for column in self.file_ordered(fields, path):
+                if column != 'eid':
+                    columns[column] = path
+        return columns
+
+    def basket_signature(self, path):
+        entry = self.catalog.files[path]
+        return (entry['mtime'], entry['size'])
+
+    def write_manifest(self, db_path, num_rows, withdrawn):
+        baskets = {path: self.basket_signature(path) for path in self.basket_fields()}
+        DatasetManifest(db_path).update(self.dataset_columns(), baskets, withdrawn, num_rows).save()
+
+    def read_columns(self, path, fields, eids=None, chunk_size=stream_chunk_size):
+        # Read with the dtypes of the catalog and without the schema, so patched rows are written like streamed ones
+        fields = self.file_ordered(fields, path)
+        if has_fresh_parquet(path):
+            return read_parquet(path, columns=fields, eids=eids)
+        dtypes = self.catalog.dtypes(fields, path)
+        if eids is None:
+            return pd.read_csv(path, usecols=fields, dtype=dtypes)
+        chunks = []
+        with pd.read_csv(path, usecols=fields, dtype=dtypes, chunksize=chunk_size) as reader:
+            for chunk in reader:
+                chunks.append(chunk[np.isin(chunk['eid'].to_numpy(), eids)])
+        return pd.concat(chunks, ignore_index=True)
+
+    def read_dataset(self, db_path, manifest, fields):
+        if has_fresh_parquet(db_path):
+            return read_parquet(db_path, columns=fields)
+        dtypes = {'eid': 'int64'}
+        for column in fields[1:]:
+            dtypes[column] = self.catalog.dtypes([column], manifest.columns[column])[column]
+        return pd.read_csv(db_path, index_col=0, usecols=lambda column: column in dtypes or column.startswith('Unnamed'),
+                           dtype=dtypes)
+
+    def basket_eids(self, path):
+        return np.unique(eid_array(self.read_columns(path, ['eid'])))
+
+    def patch_dataset(self, db_path, manifest, columns, delta, withdrawn):
+        kept = [column for column in columns if column not in delta.reread_columns]
+        df = self.read_dataset(db_path, manifest, ['eid'] + kept)
+        dataset_eids = eid_array(df)
+
+        # New participants only arrive with a new release of a basket, the dataset has the eids of every basket it reads
+        target_eids = dataset_eids
+        if len(delta.changed_baskets) != 0:
+            target_eids = self.basket_eids(self.ukb_path)
+            for path in list(self.basket_fields())[1:]:
+                target_eids = np.intersect1d(target_eids, self.basket_eids(path))
+        target_eids = np.setdiff1d(target_eids, withdrawn)
+        new_eids = np.setdiff1d(target_eids, dataset_eids)
+        df = df[np.isin(dataset_eids, target_eids)]
+        print(f"Removing {len(dataset_eids) - len(df)} participants and adding {len(new_eids)}")
+
+        if len(new_eids) != 0:
+            new_rows = None
+            for path in self.basket_fields():
+                rows = self.read_columns(path, ['eid'] + [column for column in kept if columns[column] == path], new_eids)
+                new_rows = rows if new_rows is None else new_rows.merge(rows, on='eid')
+            df = pd.concat([df, new_rows], ignore_index=True)
+
+        for path in self.basket_fields():
+            reread = [column for column in delta.reread_columns if columns[column] == path]
+            if len(reread) != 0:
+                print(f"Reading {len(reread)} columns from {path}")
+                df = df.merge(self.read_columns(path, ['eid'] + reread), on='eid', how='inner')
+
+        if self.is_eid_sorted(self.ukb_path):
+            df = df.sort_values('eid', kind='stable')
+        df = df[['eid'] + list(columns)].reset_index(drop=True)
+        tmp_path = f'{db_path}.tmp'
+        with trace_stage('UKBDatasetCreator.write_patched', df):
+            df.to_csv(tmp_path)
+        os.replace(tmp_path, db_path)
+        print(f"Saved the patched dataset to {db_path}")
+        return len(df)
+
+    def refresh_dataset(self, db_path=dataset_file, withdrawals_path=None, chunk_size=stream_chunk_size):
+        manifest = DatasetManifest(db_path)
+        has_manifest = manifest.load()
+        withdrawn = np.union1d(manifest.withdrawn, read_withdrawals(withdrawals_path))
+        if not has_manifest:
+            print("The dataset has no up to date manifest, extracting it from scratch")
+            self.stream_dataset(db_path, chunk_size, withdrawn)
+            self.extract_long_fields(chunk_size=chunk_size, exclude_eids=withdrawn)
+            return
+
+        self.generate_fields()
+        self.validate_fields()
+        columns = self.dataset_columns()
+        baskets = {path: self.basket_signature(path) for path in self.basket_fields()}
+        delta = manifest.diff(columns, baskets, withdrawn)
+        print(f"Dataset changes: {delta.describe()}")
+        if delta.is_empty():
+            print(f"{db_path} is up to date")
+            return
+
+        with trace_stage('UKBDatasetCreator.refresh_dataset') as stage:
+            num_rows = self.patch_dataset(db_path, manifest, columns, delta, withdrawn)
+            stage['rows_out'], stage['cols_out'] = num_rows, len(columns) + 1
+        self.write_manifest(db_path, num_rows, withdrawn)
+
+        # The long store has every participant of the baskets it is read from
+        long_baskets = self.long_field_columns(multi_instance_fields).keys()
+        if len(delta.new_withdrawn) != 0 or any(path in long_baskets for path in delta.changed_baskets):
+            self.extract_long_fields(chunk_size=chunk_size, exclude_eids=withdrawn)
+
+    @traced('UKBDatasetCreator.save_dataset')
+    def save_dataset(self, db_path=dataset_file):
         print(f"Saving dataset to {db_path}")
         self.df.to_csv(db_path)
 
+def convert_to_store(paths):
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"File {path} does not exist, skipping it")
+            continue
+        if path.endswith('.txt'):
+            convert_to_parquet(path, sep='\t')
+        elif path == dataset_file:
+            convert_to_parquet(path, index_col=0)
+        else:
+            convert_to_parquet(path)
+
 def main():
-    features = [
-        '1369',
-        '1309',
-        '1408',
-        '1349',
-        '1299',
-        '130622',
-        '130624',
-        '130626',
-        '130638',
-        '130694',
-        '130696',
-        '130736',
-        '130746',
-        '131052',
-        '131054',
-        '131638',
-        '131894',
-        '132122',
-        '132123',
-        '132150',
-        '132156',
-        '132157',
-        '132168',
-        '132206',
-        '132234',
-        '132244',
-        '132280',
-        '20433',
-        '20434',
-        '20445',
-        '20446',
-        '20449',
-        '20505',
-        '20510',
-        '20515',
-        '20516',
-        '20519',
-        '20520',
-        '2090',
-        '2100',
-        '21001',
-        '21002',
-        '21022',
-        '21024',
-        '21026',
-        '21045',
-        '21047',
-        '21050',
-        '21062',
-        '21063',
-        '21065',
-        '22127',
-        '23099',
-        '2714',
-        '2724',
-        '2734',
-        '2754',
-        '2774',
-        '2784',
-        '30010',
-        '30020',
-        '30030',
-        '30800',
-        '31',
-        '34',
-        '3591',
-        '3710',
-        '3720',
-        '3839',
-        '3849',
-        '40006',
-        '41272',
-        '6152',
-        '120009',
-        '120016',
-        '120017',
-        '120026',
-        '120028',
-        '120043',
-        '120044',
-        '120114',
-        '6154',
-        '132128',
-        '132106',
-        '132112',
-        '132146',
-        '130736',
-        '131628',
-        '131626',
-        '3581',
-        '3741',
-        '131638',
-        '131640',
-        '131630',
-        '21031',
-        '21045',
-        '40008',
-        '2976',
-        '2754',
-        '2764',
-        '2824',
-        '2794',
-        '2804',
-        '21050',
-        '132124',
-        '132130',
-        '132264',
-        '131604',
-        '132070',
-        '131928',
-        '132162',
-    ]
-
-    db_creator = UKBDatasetCreator(features)
-    db_creator.create_dataset()
-    db_creator.save_dataset()
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Create the merged UKB dataset")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('create', help="Extract the requested features into the merged dataset (default)")
+    refresh_parser = subparsers.add_parser('refresh', help="Patch the dataset with the changed fields, baskets and participants only")
+    refresh_parser.add_argument('--withdrawals', default=None, help="UKB withdrawal file, one eid per line")
+    convert_parser = subparsers.add_parser('convert', help="Convert the UKB and HES tables to a Parquet store sorted by eid")
+    convert_parser.add_argument('paths', nargs='*', default=ukb_files + hes_files + [dataset_file])
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert_to_store(args.paths)
+        return
+
+    db_creator = UKBDatasetCreator(requested_features)
+    if args.command == 'refresh':
+        db_creator.refresh_dataset(withdrawals_path=args.withdrawals)
+        tracer.print_summary()
+        return
+
+    db_creator.stream_dataset()
+    db_creator.print_memory_report()
+    db_creator.extract_long_fields(exclude_eids=db_creator.withdrawn)
+
+    tracer.save('dataset_trace.json')
+    tracer.print_summary()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
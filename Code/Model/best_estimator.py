@@ -1,11 +1,15 @@
 import pickle
 import json
 
-from sklearn.model_selection import train_test_split,  GridSearchCV
-from sklearn.metrics import make_scorer, accuracy_score
-from catboost import CatBoostClassifier
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import accuracy_score
 from datetime import datetime
 
+from halving_search import HalvingSearch
+from scoring import export_model
+from trial_store import TrialStore
+from stage_cache import StageCache
+from instrumentation import traced, tracer
 from create_cohort import Cohort
 from utils import *
 
@@ -18,13 +22,22 @@ params = {
 
 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-def create_x_y_from_cohort():
+# Features that give the diagnosis away or follow from it, turned into codes only when the cohort is built
+cohort_drop_features = ["Had menopause", "Ever had hysterectomy", "Age at hysterectomy", "Age at menopause", "Year of birth"]
+
+# Kept across runs, a restarted search skips the fits that are already in it
+trials_file = 'search_trials.jsonl'
+
+def load_cohort():
     logging.info("Creating the cohort")
-    cohort = Cohort()
-    cohort.create_cohort()
+    cohort = Cohort(stage_cache=StageCache())
+    # Dropped as the last cached stage, changing the list only recomputes this stage
+    cohort.create_cohort(drop_cols=[feature_to_code(feature) for feature in cohort_drop_features])
+    return cohort
 
-    cohort.drop_cols([feature_to_code("Had menopause"), feature_to_code("Ever had hysterectomy"), feature_to_code("Age at hysterectomy"), feature_to_code("Age at menopause")])
-    cohort.drop_cols([feature_to_code("Year of birth")]) 
+@traced()
+def create_x_y_from_cohort():
+    cohort = load_cohort()
 
     logging.info("Splitting to X and y")
     cohort.split_x_y()
@@ -32,13 +45,10 @@ def create_x_y_from_cohort():
 
     return X_train, X_test, y_train, y_test
 
-def create_catboost_model(params):
-    logging.info("Creating the model")
-    clf = CatBoostClassifier(verbose=False)
-    scorer = make_scorer(accuracy_score)
-    clf_grid = GridSearchCV(estimator=clf, param_grid=params, scoring=scorer, cv=5, verbose=1)
-
-    return clf_grid
+def create_catboost_search(params):
+    logging.info("Creating the model search")
+    # Successive halving over the iterations, every fold of a rung is fitted in parallel with early stopping
+    return HalvingSearch(param_grid=params, resource='iterations', factor=3, cv=5, trial_store=TrialStore(trials_file))
 
 def get_results(clf_grid):
     logging.info("Returning the results")
@@ -47,6 +57,7 @@ def get_results(clf_grid):
         'best_score': clf_grid.best_score_,
     }
 
+@traced(data_arg=1)
 def predict_model(model, X_test, y_test):
     logging.info("Getting predictions")
     y_pred = model.predict(X_test)
@@ -54,8 +65,9 @@ def predict_model(model, X_test, y_test):
     logging.info('\nCatBoost model accuracy score: {0:0.4f}'. format(accuracy_score(y_test, y_pred)))
 
 def main():
+    setup_logging()
     X_train, X_test, y_train, y_test = create_x_y_from_cohort()
-    clf_grid = create_catboost_model(params)
+    clf_grid = create_catboost_search(params)
 
     clf_grid.fit(X_train, y_train)
 
@@ -70,6 +82,10 @@ def main():
     logging.info(f"Grid search completed. Results saved with timestamp {timestamp}")
 
     pickle.dump(clf_grid, open('model.pkl','wb'))
+    export_model(clf_grid)
+
+    tracer.save(f'model_trace_{timestamp}.json')
+    tracer.print_summary()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,14 +2,34 @@ import pandas as pd
 import numpy as np
 import warnings
 
-from features_preprocess import preprocess_cat_features
+from features_preprocess import preprocess_cat_features, encode_features, encoding_spec, prefix_fields
+from long_fields import read_long_values
+from hes_aggregation import HESAggregator, file_signature, diag_file
+from diag_matrix import DiagMatrixBuilder
+from stage_cache import fingerprint, code_version
+from sampling import StratifiedSampler
+from dtype_schema import apply_schema, column_bytes, memory_report
+from instrumentation import traced
 from utils import *
 
 warnings.filterwarnings('ignore')
 
+dataset_path = "Dataset/dataset_all.csv"
+# Written by parse_database.py next to the dataset, it has every instance / array entry of the coded fields
+long_fields_path = "Dataset/dataset_long.parquet"
+
+# The methods that make up each stage, editing any of them invalidates the cached output of the stage and of
+# every stage after it
+cohort_stages = [
+    ('drop_male_patients', ['drop_male_patients']),
+    ('create_labels', ['create_labels']),
+    ('sample_patients', ['sample_patients']),
+    ('preprocess_cat_features', ['preprocess_cat_features']),
+    ('add_new_cols', ['add_new_cols', 'add_estrogen_exposure_col', 'add_num_diagnoses_col']),
+]
+
 class Cohort:
-    def __init__(self):
-        dataset_path = "Dataset/dataset_all.csv"
+    def __init__(self, stage_cache=None, sampler=None, df=None, long_fields_path=long_fields_path):
         self.cat_cols = ['had_pregnancy_complications', 'has_headache_syndromes', 'has_endocrine_disorder', 
             'has_anemia', 'has_gyno_conditions', 'has_gastro_conditions', 'had_cesarean_section', 
             'had_melanoma', 'had_cervical_cancer', 'had_breast_cancer', 'had_uterine_cancer', 'had_overian_cancer',
@@ -17,19 +37,84 @@ class Cohort:
             'has_lupus', 'has_infertility', 'has_IBS', 'had_abotrion']
         self.X = None
         self.y = None
+        # Bytes per column of the dataset as read and after the dtype schema, measured on the same frame
+        self.bytes_before_schema = None
+        self.bytes_after_schema = None
+        self.df = df
+        self.long_fields_path = long_fields_path
+        self.long_values = None
+        self.stage_cache = stage_cache
+        # Balanced 1:1 undersampling of the controls by default, e.g. StratifiedSampler(ratio=2,
+        # match_on={feature_to_code('Age at recruitment'): 5}) draws two controls of the same age band per case
+        self.sampler = sampler or StratifiedSampler()
+        # With a stage cache the dataset is only read if a stage has to be recomputed
+        if stage_cache is None and df is None:
+            self.load_dataset()
+
+    @traced()
+    def load_dataset(self):
         try:
-            self.df = pd.read_csv(dataset_path, index_col=0)
+            self.df = read_table(dataset_path, index_col=0)
+            self.bytes_before_schema = column_bytes(self.df)
+            self.df = apply_schema(self.df)
+            self.bytes_after_schema = column_bytes(self.df)
         except Exception as ee:
             logging.error(f"Cannot open CSV file - {ee}")
 
-    def create_cohort(self):
-        self.drop_male_patients()
-        self.create_labels()
-        self.sample_patients()
-        self.preprocess_cat_features()
-        self.add_new_cols()
+    @traced()
+    def create_cohort(self, drop_cols=None):
+        stages = [(name, getattr(self, name), methods, self.stage_params(name)) for name, methods in cohort_stages]
+        if drop_cols:
+            stages.append(('drop_cols', lambda: self.drop_cols(drop_cols), ['drop_cols'], {'cols': sorted(drop_cols)}))
+
+        if self.stage_cache is None:
+            for _, run, _, _ in stages:
+                run()
+        else:
+            self.run_cached_stages(stages)
+        self.df = apply_schema(self.df)
         print('Finished creating cohort')
 
+    def stage_params(self, name):
+        # Inputs of a stage that live outside of the Cohort methods
+        if name == 'preprocess_cat_features':
+            long_fields = file_signature(self.long_fields_path).tolist() if self.long_fields_path else None
+            return {'encoding_spec': encoding_spec, 'encoder': code_version(encode_features), 'long_fields': long_fields}
+        if name == 'sample_patients':
+            return {'sampler': self.sampler.params(), 'sampler_code': code_version(StratifiedSampler)}
+        if name == 'add_new_cols':
+            return {'hes': file_signature(diag_file).tolist()}
+        return {}
+
+    def dataset_fingerprint(self):
+        store_path = os.path.splitext(dataset_path)[0] + '.parquet'
+        source = store_path if has_fresh_parquet(dataset_path) else dataset_path
+        return fingerprint('dataset', source, file_signature(source).tolist())
+
+    def run_cached_stages(self, stages):
+        # Every key chains the key of the previous stage, so a change invalidates only the stages downstream of it
+        keys = []
+        key = self.dataset_fingerprint()
+        for name, _, methods, params in stages:
+            key = fingerprint(key, name, code_version(*[getattr(Cohort, method) for method in methods]), params)
+            keys.append(key)
+
+        first_stage = 0
+        for i in reversed(range(len(stages))):
+            df = self.stage_cache.get(keys[i])
+            if df is not None:
+                logging.info(f"Loaded the output of stage {stages[i][0]} from the cache")
+                self.df = df
+                first_stage = i + 1
+                break
+        if first_stage == 0:
+            self.load_dataset()
+
+        for i in range(first_stage, len(stages)):
+            stages[i][1]()
+            self.stage_cache.put(keys[i], self.df)
+
+    @traced()
     def drop_male_patients(self):
         sex_col = feature_to_code('Sex')
 
@@ -37,67 +122,85 @@ class Cohort:
         logging.info(f"Dropping column {sex_col}")
         self.df.drop(columns=[sex_col], inplace=True)
 
+    @traced()
     def create_labels(self):
         logging.info("Creating label column")
         endo_diag_col = '132123-0.0'
         endo_date_col = '132122-0.0'
 
-        self.df['has_endo'] = self.df[endo_diag_col].isna().astype(int).apply(lambda x: 0 if x else 1)
+        self.df['has_endo'] = self.df[endo_diag_col].notna().astype(int)
         logging.info(f"Dropping columns {code_to_feature(endo_diag_col), code_to_feature(endo_date_col)}")
         self.df.drop(columns=[endo_diag_col, endo_date_col], inplace=True)
 
+    @traced()
     def sample_patients(self):
         logging.info("Sampling patients")
-        num_endo_patients  = self.df['has_endo'].value_counts()[1]
-        y_has_endo = self.df[self.df['has_endo'] == 1]
-        y_no_endo = self.df[self.df['has_endo'] == 0]
-
-        y_no_endo = y_no_endo.sample(n=num_endo_patients)
-
-        self.df = pd.concat([y_has_endo, y_no_endo])
+        positions = self.sampler.sample(self.df, 'has_endo')
+        self.df = self.df.take(positions)
 
+    @traced()
     def preprocess_cat_features(self):
         logging.info("Preprocessing categorical features")
-        preprocess_cat_features(self.df)
-
+        preprocess_cat_features(self.df, self.read_long_values())
+
+    def read_long_values(self):
+        # Without the long store the coded fields are encoded from their instance 0 column in the dataset
+        if self.long_values is not None:
+            return self.long_values
+        if self.long_fields_path is None or not os.path.exists(self.long_fields_path):
+            return None
+        logging.info(f"Reading every instance of the coded fields from {self.long_fields_path}")
+        return read_long_values(self.long_fields_path, prefix_fields(), self.df['eid'].to_numpy())
+
+    @traced()
     def add_new_cols(self):
         self.add_estrogen_exposure_col()
         self.add_num_diagnoses_col()
 
+    @traced()
     def add_estrogen_exposure_col(self):
         logging.info("Adding estrogen exposure column")
         menarche_age_code = feature_to_code("menarche")
         menopause_age_code = feature_to_code("Age at menopause")
 
-        def calc_estrogen_exposure(row):
-            answer_not_known = [-1, 3]
-            if pd.isna(row[menarche_age_code]) or pd.isna(row[menopause_age_code]):
-                return np.nan
-            elif (row[menarche_age_code] in answer_not_known) or (row[menopause_age_code] in answer_not_known):
-                return np.nan
-            elif row[menopause_age_code] > row[menarche_age_code]:
-                return row[menopause_age_code] - row[menarche_age_code]
-            else:
-                return np.nan  
+        answer_not_known = [-1, 3]
+        menarche_age = self.df[menarche_age_code].to_numpy(dtype=float)
+        menopause_age = self.df[menopause_age_code].to_numpy(dtype=float)
 
-        self.df['estrogen_exposure'] = self.df.apply(calc_estrogen_exposure, axis=1)
+        # NaN ages fail the comparison, so they end up as NaN like the unknown answers
+        is_known = ~np.isin(menarche_age, answer_not_known) & ~np.isin(menopause_age, answer_not_known)
+        is_valid = is_known & (menopause_age > menarche_age)
+        self.df['estrogen_exposure'] = np.where(is_valid, menopause_age - menarche_age, np.nan)
 
-    def add_num_diagnoses_col(self):
+    @traced()
+    def add_num_diagnoses_col(self, code_counts=None):
         logging.info("Adding number of diagnoses column")
-        diag_file = 'biobank/hesin_diag.txt'
-        diag_df = pd.read_csv(diag_file, sep ='\t')
-
-        code_counts = diag_df.groupby('eid')['diag_icd10'].count().reset_index(name='diag_count')
+        if code_counts is None:
+            code_counts = HESAggregator().diag_counts()
         self.df = self.df.merge(code_counts, on='eid', how='left')
         self.df['diag_count'] = self.df['diag_count'].fillna(0)
+        # The eids stay as the index, they align the cohort rows with the diagnosis matrix
+        self.df.index = pd.Index(self.df['eid'].to_numpy(), name='eid')
         self.df.drop(columns=['eid'], inplace=True)
 
+    def diag_matrix(self, level='code3'):
+        # Sparse participant x ICD-10 counts in the cohort row order, built from hesin_diag.txt and cached next to it
+        diag_matrix = DiagMatrixBuilder().load(level)
+        return diag_matrix.aligned(self.df.index.to_numpy()), diag_matrix.columns
+
+    def memory_report(self):
+        if self.bytes_before_schema is None:
+            return None
+        return memory_report(self.bytes_before_schema, self.bytes_after_schema)
+
+    @traced()
     def drop_cols(self, cols):
         self.df.drop(columns=cols, inplace=True, errors='ignore')
 
+    @traced()
     def split_x_y(self):
         y_column = "has_endo"
         self.X = self.df.drop(y_column, axis=1)
         self.y = self.df[y_column]
 
-        self.X.columns = self.X.columns.to_series().apply(code_to_feature)
\ No newline at end of file
+        self.X.columns = codes_to_features(self.X.columns)
\ No newline at end of file
@@ -0,0 +1,100 @@
+import scipy.sparse as sp
+import pandas as pd
+import numpy as np
+import logging
+import os
+
+from hes_aggregation import diag_file, hes_chunk_size, icd10_chapters, icd10_chapter_names, file_signature
+from utils import iter_table
+
+# Columns are the 3 character ICD-10 codes ("N80") or the ICD-10 chapters, both are built in the same pass
+diag_levels = ['code3', 'chapter']
+# Stored with the matrices, a cache written by an older build of them is rebuilt
+diag_matrix_version = 2
+
+class DiagMatrix:
+    def __init__(self, matrix, eids, columns):
+        # One row per participant with a HES diagnosis, sorted by eid, the values are the number of diagnoses
+        self.matrix = matrix
+        self.eids = eids
+        self.columns = columns
+
+    def aligned(self, eids):
+        # Rows in the order of the given eids, participants without HES diagnoses get an empty row
+        eids = np.asarray(eids, dtype=np.int64)
+        if len(self.eids) == 0:
+            return sp.csr_matrix((len(eids), len(self.columns)), dtype=np.float32)
+        positions = np.minimum(np.searchsorted(self.eids, eids), len(self.eids) - 1)
+        matched = (self.eids[positions] == eids).astype(np.float32)
+        return (sp.diags(matched) @ self.matrix[positions]).tocsr()
+
+class DiagMatrixBuilder:
+    def __init__(self, diag_path=diag_file, chunk_size=hes_chunk_size):
+        self.diag_path = diag_path
+        self.chunk_size = chunk_size
+
+    def cache_path(self, level):
+        return os.path.splitext(self.diag_path)[0] + f'_matrix_{level}.npz'
+
+    def load(self, level='code3'):
+        assert level in diag_levels, f"Unknown diagnosis level {level}, expected one of {diag_levels}"
+        matrix = self.read_cache(level)
+        if matrix is None:
+            self.build()
+            matrix = self.read_cache(level)
+        return matrix
+
+    def read_cache(self, level):
+        path = self.cache_path(level)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as cache:
+            if not np.array_equal(cache['diag_signature'], file_signature(self.diag_path)):
+                logging.info(f"{self.diag_path} changed, the diagnosis matrix cache is stale")
+                return None
+            if 'version' not in cache or int(cache['version']) != diag_matrix_version:
+                logging.info(f"The diagnosis matrix cache of {self.diag_path} was built by an older version")
+                return None
+            matrix = sp.csr_matrix((cache['data'], cache['indices'], cache['indptr']), shape=tuple(cache['shape']))
+            return DiagMatrix(matrix, cache['eids'], list(cache['columns']))
+
+    def build(self):
+        logging.info(f"Building the diagnosis matrices of {self.diag_path}")
+        partial_counts = {level: [] for level in diag_levels}
+        for chunk in iter_table(self.diag_path, ['eid', 'diag_icd10'], self.chunk_size, sep='\t'):
+            chunk = chunk[chunk['diag_icd10'].notna()]
+            codes = chunk['diag_icd10'].astype(str)
+            eids = chunk['eid'].to_numpy(dtype=np.int64)
+            chapters = icd10_chapters(codes)
+            # Codes that sort before A00 have no chapter (-1), like in diag_counts they are only counted per code
+            has_chapter = chapters >= 0
+            keys = {
+                'code3': (eids, codes.str[:3].str.upper().to_numpy()),
+                'chapter': (eids[has_chapter], np.asarray(icd10_chapter_names, dtype=object)[chapters[has_chapter]]),
+            }
+            for level in diag_levels:
+                # Counted per chunk, so only the distinct (participant, code) pairs are kept in memory
+                pairs = pd.DataFrame({'eid': keys[level][0], 'key': keys[level][1]})
+                partial_counts[level].append(pairs.groupby(['eid', 'key']).size())
+
+        signature = file_signature(self.diag_path)
+        for level in diag_levels:
+            if partial_counts[level]:
+                counts = pd.concat(partial_counts[level]).groupby(level=[0, 1]).sum()
+            else:
+                counts = pd.Series([], index=pd.MultiIndex.from_arrays([[], []]), dtype=np.int64)
+            eid_codes, eids = pd.factorize(counts.index.get_level_values(0), sort=True)
+            key_codes, keys = pd.factorize(counts.index.get_level_values(1), sort=True)
+            prefix = 'icd10_' if level == 'code3' else 'diag_chapter_'
+            matrix = sp.csr_matrix((counts.to_numpy(dtype=np.float32), (eid_codes, key_codes)), shape=(len(eids), len(keys)))
+            np.savez(self.cache_path(level), data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                     shape=np.array(matrix.shape), eids=np.asarray(eids, dtype=np.int64),
+                     columns=np.array([prefix + str(key) for key in keys], dtype=str), diag_signature=signature,
+                     version=diag_matrix_version)
+            logging.info(f"Saved the {level} diagnosis matrix ({matrix.shape[0]} x {matrix.shape[1]}, "
+                         f"{matrix.nnz} values) to {self.cache_path(level)}")
+
+def combine_features(X, diag_matrix):
+    # The dense cohort features next to the sparse diagnoses, models with a sparse path take the CSR as is
+    dense = sp.csr_matrix(np.asarray(X, dtype=np.float32))
+    return sp.hstack([dense, diag_matrix], format='csr')
@@ -0,0 +1,46 @@
+import pandas as pd
+import numpy as np
+import logging
+
+flag_prefixes = ('has_', 'had_')
+
+def compact_dtype(column, dtype):
+    dtype = pd.api.types.pandas_dtype(dtype)
+    if column == 'eid':
+        return 'int32'
+    if column.startswith(flag_prefixes) and (pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype)):
+        return 'int8'
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+        # ICD-10 / OPCS4 codes, report sources and first reported dates repeat a few thousand values at most
+        return 'category'
+    if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+        # Continuous measures and UKB answer codes, float keeps the NaNs and the -1/-3 codes numeric for the models
+        return 'float32'
+    return dtype
+
+def build_schema(dtypes):
+    return {column: compact_dtype(column, dtype) for column, dtype in dict(dtypes).items()}
+
+def apply_schema(df, schema=None):
+    if schema is None:
+        schema = build_schema(df.dtypes)
+    changed = {column: dtype for column, dtype in schema.items() if column in df.columns and df[column].dtype != dtype}
+    if len(changed) == 0:
+        return df
+    return df.astype(changed)
+
+def column_bytes(df):
+    return df.memory_usage(index=False, deep=True)
+
+def memory_report(before, after):
+    report = pd.DataFrame({'bytes_before': before, 'bytes_after': after})
+    report['saved_pct'] = ((1 - report['bytes_after'] / report['bytes_before']) * 100).round(1)
+    return report.sort_values('bytes_before', ascending=False)
+
+def print_memory_report(before, after, max_rows=20):
+    report = memory_report(before, after)
+    total_before = report['bytes_before'].sum() / 2 ** 20
+    total_after = report['bytes_after'].sum() / 2 ** 20
+    logging.info(f"Memory usage {total_before:.1f} MB -> {total_after:.1f} MB")
+    print(report.head(max_rows).to_string())
+    return report
@@ -1,83 +1,99 @@
 import pandas as pd
 import numpy as np
 
+from instrumentation import traced
 from utils import feature_to_code
-    
-def encode_one_hot_by_nans(df, feature_list, new_feature_name):
-    df[new_feature_name] = pd.DataFrame(df[feature_list]).any(axis=1).astype(int)
-    df.drop(columns=feature_list, inplace=True)
 
-def encode_one_hot_by_string_val(df, feature_code, str_match, new_feature_name):
-    df[new_feature_name] = df[feature_code].str.startswith(str_match, na=False).astype(int)
+# Every encoded feature is 1 when one of its source features has a value ("Date ... first reported" columns)
+# or when one of its coded source features starts with one of the given ICD-10 / OPCS4 prefixes.
+# Adding a condition group only needs a new row here.
+encoding_spec = [
+    ('had_pregnancy_complications', ["O26", "O44", "O60", "O00", "O70"], {}),
+    ('has_headache_syndromes', ["G43", "G44"], {}),
+    ('has_endocrine_disorder', ["E02", "E03", "E34"], {}),
+    ('has_anemia', ["D50", "D51", "D52", "D59"], {}),
+    ('had_cesarean_section', ["O82"], {"Operative procedures": ('R17', 'R18')}),
+    ('had_overian_cancer', [], {"cancer": ('C56',)}),
+    ('had_uterine_cancer', [], {"cancer": ('C55',)}),
+    ('had_breast_cancer', [], {"cancer": ('C50',)}),
+    ('had_cervical_cancer', [], {"cancer": ('C53',)}),
+    ('had_melanoma', [], {"cancer": ('C44', 'C43')}),
+    ('has_gyno_conditions', ["N81", "N84", "N83", "N70", "N73"], {}),
+    ('has_gastro_conditions', ["K52", "K59", "K50", "K51"], {}),
+    ('had_abotrion', ["O03"], {}),
+    ('has_IBS', ["K58"], {}),
+    ('has_infertility', ["N97"], {}),
+    ('has_lupus', ["M32"], {}),
+    ('has_menstrual_pain', ["N94"], {}),
+    ('has_back_pain', ["M54"], {}),
+    ('had_UTI', ["N39"], {}),
+    ('had_appendicitis', ["K35"], {}),
+    ('has_excessive_menstruation', ["N92"], {}),
+    ('has_PCOS', ["E28"], {}),
+]
 
-def encode_single_feature(df, feature_code, new_feature_name):
-    code = feature_to_code(feature_code)
-    encode_one_hot_by_nans(df, code, new_feature_name)
-    
-def encode_pregnancy_comp_feature(df):
-    pregnancy_complications_codes = [feature_to_code("O26"), feature_to_code("O44"), feature_to_code("O60"), feature_to_code("O00"), feature_to_code("O70")]
-    encode_one_hot_by_nans(df, pregnancy_complications_codes, 'had_pregnancy_complications')
+class PrefixIndex:
+    def __init__(self, values):
+        # Compact frames hold the codes as categoricals, an all-NaN category column has no .str accessor
+        self.values = values.astype(object)
+        self.prefixes = {}
 
-def encode_headache_feature(df):
-    headache_syndromes_codes = [feature_to_code("G43"), feature_to_code("G44")]
-    encode_one_hot_by_nans(df, headache_syndromes_codes, 'has_headache_syndromes')
+    def matches(self, prefixes):
+        # The column is factorized once per prefix length, each lookup then only checks the distinct prefixes
+        length = len(prefixes[0])
+        assert all(len(prefix) == length for prefix in prefixes), "Prefixes of one feature must have the same length"
+        if length not in self.prefixes:
+            self.prefixes[length] = pd.factorize(self.values.str[:length])
+        codes, uniques = self.prefixes[length]
+        is_match = np.append(np.isin(np.asarray(uniques, dtype=object), prefixes), False)
+        return is_match[codes]
 
-def encode_endocrine_feature(df):
-    hypothyroidism_code = feature_to_code("E02") # 130694
-    general_hypothyroidism_code = feature_to_code("E03") # 130696
-    general_endocrine_code = feature_to_code("E34") # 130746
-    endocrine_codes = [hypothyroidism_code, general_hypothyroidism_code, general_endocrine_code]
-    
-    encode_one_hot_by_nans(df, endocrine_codes, 'has_endocrine_disorder')
+class LongPrefixIndex:
+    def __init__(self, long_values, row_eids):
+        # Every instance / array entry of one field, a row matches when any of its participant's codes matches
+        self.eids = long_values['eid'].to_numpy()
+        self.index = PrefixIndex(long_values['value'])
+        self.row_eids = row_eids
 
-def encode_anemia_feature(df):
-    iron_def_anemia_code = feature_to_code("D50")
-    b12_def_anemia_code = feature_to_code("D51")
-    folate_def_anemia_code = feature_to_code("D52")
-    aquired_anemia_code = feature_to_code("D59")
+    def matches(self, prefixes):
+        return np.isin(self.row_eids, self.eids[self.index.matches(prefixes)])
 
-    anemia_codes = [iron_def_anemia_code, b12_def_anemia_code, folate_def_anemia_code, aquired_anemia_code]
-    encode_one_hot_by_nans(df, anemia_codes, 'has_anemia')
-    
-def encode_genital_conditions_feature(df):
-    genital_conditions_codes = [feature_to_code("N81"), feature_to_code("N84"), feature_to_code("N83"), feature_to_code("N70"), feature_to_code("N73")]
-    encode_one_hot_by_nans(df, genital_conditions_codes, 'has_gyno_conditions')
-    
-def encode_gastro_conditions(df):
-    gastro_conditions_codes = [feature_to_code("K52"), feature_to_code("K59"), feature_to_code("K50"), feature_to_code("K51")]
-    encode_one_hot_by_nans(df, gastro_conditions_codes, 'has_gastro_conditions')
+def prefix_index(df, code, long_values):
+    # The wide frame only holds instance 0 of a field, the long store has all of its codes
+    if long_values is None:
+        return PrefixIndex(df[code])
+    field = int(code.split('-')[0])
+    return LongPrefixIndex(long_values[long_values['field'].to_numpy() == field], df['eid'].to_numpy())
 
-def encode_cesarean_feature(df):
-    operation_code = feature_to_code("Operative procedures")
-    cesarean_code = feature_to_code("O82") # 132280
-    df['had_cesarean_section'] = np.where(df[operation_code].str.startswith(('R17', 'R18'), na=False) | df[cesarean_code].notna(), 1, 0)
-    df.drop(columns=[operation_code, cesarean_code], inplace=True)
+@traced()
+def encode_features(df, spec=encoding_spec, long_values=None):
+    spec_presence_codes = [[feature_to_code(feature) for feature in features] for _, features, _ in spec]
+    presence_codes = list(dict.fromkeys(code for codes in spec_presence_codes for code in codes))
+    prefix_codes = list(dict.fromkeys(feature_to_code(feature) for _, _, prefix_features in spec for feature in prefix_features))
+    prefix_indexes = {code: prefix_index(df, code, long_values) for code in prefix_codes}
 
-def encode_cancer_feature(df):
-    cancer_code = feature_to_code("cancer")
-    encode_one_hot_by_string_val(df, cancer_code, ('C56'), 'had_overian_cancer')
-    encode_one_hot_by_string_val(df, cancer_code, ('C55'), 'had_uterine_cancer')
-    encode_one_hot_by_string_val(df, cancer_code, ('C50'), 'had_breast_cancer')
-    encode_one_hot_by_string_val(df, cancer_code, ('C53'), 'had_cervical_cancer')
-    encode_one_hot_by_string_val(df, cancer_code, ('C44', 'C43'), 'had_melanoma')
-    df.drop(columns=[cancer_code], inplace=True)
+    # One source column per presence feature and per (coded feature, prefixes) pair, a single product
+    # of the sources with their membership matrix then gives every encoded feature at once
+    sources = [df[presence_codes].notna().to_numpy()]
+    membership = [[code in codes for codes in spec_presence_codes] for code in presence_codes]
+    for i, (_, _, prefix_features) in enumerate(spec):
+        for feature, prefixes in prefix_features.items():
+            sources.append(prefix_indexes[feature_to_code(feature)].matches(prefixes)[:, None])
+            membership.append([j == i for j in range(len(spec))])
 
-def preprocess_cat_features(df):
-    encode_pregnancy_comp_feature(df)
-    encode_headache_feature(df)
-    encode_endocrine_feature(df)
-    encode_anemia_feature(df)
-    encode_cesarean_feature(df)
-    encode_cancer_feature(df)
-    encode_genital_conditions_feature(df)
-    encode_gastro_conditions(df)
-    encode_single_feature(df, "O03", 'had_abotrion')
-    encode_single_feature(df, "K58", 'has_IBS')
-    encode_single_feature(df, "N97", 'has_infertility')
-    encode_single_feature(df, "M32", 'has_lupus')
-    encode_single_feature(df, "N94", 'has_menstrual_pain')
-    encode_single_feature(df, "M54", 'has_back_pain')
-    encode_single_feature(df, "N39", 'had_UTI')
-    encode_single_feature(df, "K35", 'had_appendicitis')
-    encode_single_feature(df, "N92", 'has_excessive_menstruation')
-    encode_single_feature(df, "E28", 'has_PCOS')
\ No newline at end of file
+    sources = np.hstack(sources).astype(np.float32)
+    encoded = (sources @ np.array(membership, dtype=np.float32)) > 0
+
+    df.drop(columns=presence_codes + [code for code in prefix_codes if code not in presence_codes], inplace=True, errors='ignore')
+    df[[name for name, _, _ in spec]] = encoded.astype(int)
+
+def prefix_fields(spec=encoding_spec):
+    return list(dict.fromkeys(int(feature_to_code(feature).split('-')[0]) for _, _, prefix_features in spec for feature in prefix_features))
+
+def encoding_source_codes(spec=encoding_spec):
+    codes = [feature_to_code(feature) for _, features, _ in spec for feature in features]
+    codes += [feature_to_code(feature) for _, _, prefix_features in spec for feature in prefix_features]
+    return list(dict.fromkeys(codes))
+
+def preprocess_cat_features(df, long_values=None):
+    encode_features(df, long_values=long_values)
\ No newline at end of file
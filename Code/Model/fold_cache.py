@@ -0,0 +1,83 @@
+import scipy.sparse as sp
+import numpy as np
+import tempfile
+import shutil
+import json
+import os
+
+from sklearn.model_selection import StratifiedKFold
+
+from quantized_data import QuantizedData
+
+fold_cache_meta = 'folds.json'
+
+def create_fold_cache(X, y, cv=5, random_state=42, cache_dir=None):
+    # The cohort is converted to one float32 matrix once, every model and fold reads it memory mapped
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix='fold_cache_')
+    os.makedirs(cache_dir, exist_ok=True)
+    # Pools quantized from a previous cohort in the same directory are not valid anymore
+    shutil.rmtree(os.path.join(cache_dir, 'quantized'), ignore_errors=True)
+    y_values = np.asarray(y).astype(np.int8)
+
+    row_folds = np.empty(len(y_values), dtype=np.int8)
+    splitter = StratifiedKFold(n_splits=cv, shuffle=True, random_state=random_state)
+    for fold, (_, test_index) in enumerate(splitter.split(np.zeros(len(y_values)), y_values)):
+        row_folds[test_index] = fold
+
+    if sp.issparse(X):
+        # Sparse matrices (the diagnosis features) cannot be memory mapped, the workers load the CSR arrays
+        sp.save_npz(os.path.join(cache_dir, 'X.npz'), sp.csr_matrix(X, dtype=np.float32), compressed=False)
+    else:
+        np.save(os.path.join(cache_dir, 'X.npy'), np.ascontiguousarray(np.asarray(X, dtype=np.float32)))
+    np.save(os.path.join(cache_dir, 'y.npy'), y_values)
+    np.save(os.path.join(cache_dir, 'row_folds.npy'), row_folds)
+    columns = [str(column) for column in X.columns] if hasattr(X, 'columns') else None
+    with open(os.path.join(cache_dir, fold_cache_meta), 'w') as f:
+        json.dump({'cv': cv, 'random_state': random_state, 'columns': columns}, f)
+    return FoldCache(cache_dir)
+
+class FoldCache():
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, fold_cache_meta), 'r') as f:
+            meta = json.load(f)
+        self.cv = meta['cv']
+        self.columns = meta['columns']
+        self.arrays = None
+        self.quantized_data = None
+
+    def __getstate__(self):
+        # Only the directory is sent to worker processes, they map the arrays themselves
+        return {'cache_dir': self.cache_dir, 'cv': self.cv, 'columns': self.columns, 'arrays': None,
+                'quantized_data': None}
+
+    def load(self):
+        if self.arrays is None:
+            self.arrays = {name: np.load(os.path.join(self.cache_dir, f'{name}.npy'), mmap_mode='r')
+                           for name in ('y', 'row_folds')}
+            sparse_path = os.path.join(self.cache_dir, 'X.npz')
+            if os.path.exists(sparse_path):
+                self.arrays['X'] = sp.load_npz(sparse_path)
+            else:
+                self.arrays['X'] = np.load(os.path.join(self.cache_dir, 'X.npy'), mmap_mode='r')
+        return self.arrays
+
+    def quantized(self):
+        # The CatBoost / XGBoost form of the folds, shared by every model fitted on the same fold
+        if self.quantized_data is None:
+            self.quantized_data = QuantizedData(os.path.join(self.cache_dir, 'quantized'))
+        return self.quantized_data
+
+    def indices(self, fold):
+        row_folds = self.load()['row_folds']
+        return np.flatnonzero(row_folds != fold), np.flatnonzero(row_folds == fold)
+
+    def fold(self, fold):
+        arrays = self.load()
+        train_index, test_index = self.indices(fold)
+        return arrays['X'][train_index], arrays['y'][train_index], arrays['X'][test_index], arrays['y'][test_index]
+
+    def remove(self):
+        self.arrays = None
+        self.quantized_data = None
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -0,0 +1,197 @@
+import numpy as np
+import logging
+import tempfile
+import math
+import time
+import os
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.model_selection import ParameterGrid, StratifiedKFold, train_test_split
+from sklearn.metrics import accuracy_score
+from catboost import CatBoostClassifier, Pool
+
+from instrumentation import traced, trace_stage, peak_rss_mb
+from quantized_data import QuantizedData
+from trial_store import dataset_fingerprint, trial_key
+
+# Set once per worker process by the pool initializer, so the cohort is not pickled with every task
+worker_data = {}
+
+def init_worker(X, y, folds, quantized=None):
+    worker_data['X'] = X
+    worker_data['y'] = y
+    worker_data['folds'] = folds
+    worker_data['quantized'] = quantized
+
+def validation_split(X, y, train_index, validation_size, random_state):
+    return train_test_split(X.iloc[train_index], y.iloc[train_index], test_size=validation_size,
+                            stratify=y.iloc[train_index], random_state=random_state)
+
+def fit_fold(config_index, config, fold, iterations, thread_count, early_stopping_rounds, validation_size, random_state):
+    X, y = worker_data['X'], worker_data['y']
+    train_index, test_index = worker_data['folds'][fold]
+    quantized = worker_data['quantized']
+    fit_name, val_name = f'fold{fold}_fit', f'fold{fold}_val'
+    if quantized is not None and fit_name in quantized.pools:
+        train_data, eval_set = quantized.pools[fit_name], quantized.pools[val_name]
+    else:
+        X_fit, X_val, y_fit, y_val = validation_split(X, y, train_index, validation_size, random_state)
+        if quantized is not None:
+            # Binned once per worker on the borders of the fold, every later configuration and rung reuses the pools
+            train_data = quantized.catboost_pool(fit_name, X_fit, y_fit)
+            eval_set = quantized.catboost_pool(val_name, X_val, y_val, reference=fit_name)
+        else:
+            train_data, eval_set = Pool(X_fit, y_fit), (X_val, y_val)
+
+    peak_before = peak_rss_mb()
+    start = time.perf_counter()
+    model = CatBoostClassifier(**config, iterations=iterations, thread_count=thread_count,
+                               early_stopping_rounds=early_stopping_rounds, verbose=False)
+    model.fit(train_data, eval_set=eval_set)
+    fit_time = time.perf_counter() - start
+    peak_after = peak_rss_mb()
+
+    score = accuracy_score(y.iloc[test_index], model.predict(X.iloc[test_index]))
+    return {
+        'config_index': config_index,
+        'fold': fold,
+        'iterations': iterations,
+        'score': float(score),
+        'best_iteration': model.get_best_iteration(),
+        'fit_time': fit_time,
+        # Growth of the worker's peak RSS during this fit, like the peak_rss_delta_mb of the traced stages
+        'peak_rss_delta_mb': peak_after - peak_before if peak_after is not None else None,
+    }
+
+class HalvingSearch:
+    def __init__(self, param_grid, resource='iterations', factor=3, min_resource=None, cv=5, n_jobs=None,
+                 early_stopping_rounds=20, validation_size=0.1, random_state=42, trial_store=None,
+                 quantize=True):
+        self.param_grid = param_grid
+        self.resource = resource
+        self.factor = factor
+        self.min_resource = min_resource
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.early_stopping_rounds = early_stopping_rounds
+        self.validation_size = validation_size
+        self.random_state = random_state
+        self.trial_store = trial_store
+        self.quantize = quantize
+        self.fingerprint = None
+        self.cv_results_ = []
+        self.best_params_ = None
+        self.best_score_ = None
+        self.best_iterations_ = None
+        self.best_estimator_ = None
+
+    def budgets(self):
+        max_resource = max(self.param_grid[self.resource])
+        min_resource = self.min_resource or min(self.param_grid[self.resource])
+        num_rungs = int(math.floor(math.log(max_resource / min_resource, self.factor) + 1e-9)) + 1
+        return [int(round(max_resource / self.factor ** rung)) for rung in reversed(range(num_rungs))]
+
+    def pool_size(self, num_tasks):
+        num_cpus = self.n_jobs or os.cpu_count()
+        num_workers = max(1, min(num_cpus, num_tasks))
+        # CatBoost threads of all the workers together should not exceed the cores
+        return num_workers, max(1, num_cpus // num_workers)
+
+    def key(self, config, fold, iterations):
+        settings = {
+            'cv': self.cv,
+            'dataset': self.fingerprint,
+            'early_stopping_rounds': self.early_stopping_rounds,
+            'validation_size': self.validation_size,
+            'random_state': self.random_state,
+        }
+        return trial_key({**config, self.resource: iterations}, fold, settings)
+
+    def run_rung(self, executor, configs, config_indexes, iterations, thread_count):
+        scores = {index: [] for index in config_indexes}
+        futures = []
+        for index in config_indexes:
+            for fold in range(self.cv):
+                trial = self.trial_store.get(self.key(configs[index], fold, iterations)) if self.trial_store else None
+                if trial is not None:
+                    scores[index].append(trial['score'])
+                    self.cv_results_.append({**trial, 'config_index': index})
+                    continue
+                futures.append(executor.submit(fit_fold, index, configs[index], fold, iterations, thread_count,
+                                               self.early_stopping_rounds, self.validation_size, self.random_state))
+        logging.info(f"Running {len(futures)} fits, {sum(map(len, scores.values()))} were already in the trial store")
+
+        for future in as_completed(futures):
+            result = future.result()
+            scores[result['config_index']].append(result['score'])
+            self.cv_results_.append(result)
+            if self.trial_store is not None:
+                config = configs[result['config_index']]
+                self.trial_store.record(self.key(config, result['fold'], iterations),
+                                        {**result, 'params': config, 'dataset': self.fingerprint})
+        return {index: float(np.mean(fold_scores)) for index, fold_scores in scores.items()}
+
+    def quantize_folds(self, X, y, folds):
+        # The configurations only change the trees, the borders of a fold are the same for all of them
+        quantized = QuantizedData(tempfile.mkdtemp(prefix='halving_pools_'))
+        with trace_stage('HalvingSearch.quantize', X):
+            for fold, (train_index, _) in enumerate(folds):
+                X_fit, _, y_fit, _ = validation_split(X, y, train_index, self.validation_size, self.random_state)
+                quantized.catboost_pool(f'fold{fold}_fit', X_fit, y_fit)
+        # Only the borders are kept, the workers bin their own pools
+        quantized.release()
+        return quantized
+
+    @traced('HalvingSearch.fit', data_arg=1)
+    def fit(self, X, y):
+        configs = list(ParameterGrid({name: values for name, values in self.param_grid.items() if name != self.resource}))
+        folds = list(StratifiedKFold(n_splits=self.cv).split(X, y))
+        budgets = self.budgets()
+        self.fingerprint = dataset_fingerprint(X, y)
+        num_workers, thread_count = self.pool_size(len(configs) * self.cv)
+        logging.info(f"Searching {len(configs)} configurations over {self.resource} budgets {budgets} "
+                     f"with {num_workers} workers of {thread_count} threads")
+
+        self.cv_results_ = []
+        survivors = list(range(len(configs)))
+        # A grid over the border count needs its own quantization per configuration
+        quantized = self.quantize_folds(X, y, folds) if self.quantize and 'border_count' not in self.param_grid else None
+        try:
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                                     initargs=(X, y, folds, quantized)) as executor:
+                for rung, iterations in enumerate(budgets):
+                    mean_scores = self.run_rung(executor, configs, survivors, iterations, thread_count)
+                    ranked = sorted(survivors, key=lambda index: mean_scores[index], reverse=True)
+                    logging.info(f"Rung {rung}: {len(survivors)} configurations with {iterations} {self.resource}, "
+                                 f"best score {mean_scores[ranked[0]]:.4f}")
+                    if rung != len(budgets) - 1:
+                        survivors = ranked[:max(1, math.ceil(len(survivors) / self.factor))]
+        finally:
+            if quantized is not None:
+                quantized.remove()
+
+        best_index = ranked[0]
+        self.best_params_ = {**configs[best_index], self.resource: budgets[-1]}
+        self.best_score_ = mean_scores[best_index]
+
+        # The refit has no validation split, it stops where early stopping stopped the folds of the last rung
+        best_iterations = [result['best_iteration'] for result in self.cv_results_
+                           if result['config_index'] == best_index and result['iterations'] == budgets[-1]
+                           and result.get('best_iteration') is not None]
+        params = dict(self.best_params_)
+        if best_iterations:
+            params['iterations'] = int(np.median(best_iterations)) + 1
+        self.best_iterations_ = params.get('iterations')
+
+        logging.info(f"Refitting the best configuration {self.best_params_} with {self.best_iterations_} iterations")
+        self.best_estimator_ = CatBoostClassifier(**params, thread_count=self.n_jobs or -1, verbose=False)
+        with trace_stage('HalvingSearch.refit', X):
+            self.best_estimator_.fit(X, y)
+        return self
+
+    @traced('HalvingSearch.predict', data_arg=1)
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
@@ -0,0 +1,112 @@
+import pandas as pd
+import numpy as np
+import logging
+import os
+
+from utils import iter_table
+
+diag_file = 'biobank/hesin_diag.txt'
+episodes_file = 'biobank/hesin.txt'
+hes_chunk_size = 1000000
+
+# First code of every ICD-10 chapter, codes are mapped to the chapter whose start is the last one not after them
+icd10_chapter_starts = ['A00', 'C00', 'D50', 'E00', 'F00', 'G00', 'H00', 'H60', 'I00', 'J00', 'K00',
+                        'L00', 'M00', 'N00', 'O00', 'P00', 'Q00', 'R00', 'S00', 'U00', 'V01', 'Z00']
+icd10_chapter_names = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X', 'XI',
+                       'XII', 'XIII', 'XIV', 'XV', 'XVI', 'XVII', 'XVIII', 'XIX', 'XXII', 'XX', 'XXI']
+
+def icd10_chapters(codes):
+    codes = pd.Series(codes).astype(str).str[:3].str.upper().to_numpy(dtype='U3')
+    return np.searchsorted(np.array(icd10_chapter_starts), codes, side='right') - 1
+
+def file_signature(path):
+    if not os.path.exists(path):
+        return np.array([0.0, 0.0])
+    stat = os.stat(path)
+    return np.array([stat.st_mtime, stat.st_size])
+
+class HESAggregator:
+    def __init__(self, diag_path=diag_file, episodes_path=episodes_file, chunk_size=hes_chunk_size):
+        self.diag_path = diag_path
+        self.episodes_path = episodes_path
+        self.chunk_size = chunk_size
+        self.cache_path = os.path.splitext(diag_path)[0] + '_aggregates.npz'
+        self.aggregates = None
+
+    def load(self):
+        if self.aggregates is None:
+            self.aggregates = self.read_cache()
+        if self.aggregates is None:
+            self.aggregates = self.aggregate()
+            np.savez(self.cache_path, **self.aggregates)
+            logging.info(f"Saved the HES aggregates to {self.cache_path}")
+        return self.aggregates
+
+    def read_cache(self):
+        if not os.path.exists(self.cache_path):
+            return None
+        with np.load(self.cache_path) as cache:
+            aggregates = {key: cache[key] for key in cache.files}
+        if not (np.array_equal(aggregates['diag_signature'], file_signature(self.diag_path)) and
+                np.array_equal(aggregates['episodes_signature'], file_signature(self.episodes_path))):
+            logging.info("HES files changed, the aggregates cache is stale")
+            return None
+        return aggregates
+
+    def aggregate(self):
+        logging.info(f"Aggregating the diagnoses of {self.diag_path}")
+        chapters = range(len(icd10_chapter_starts))
+        partial_counts = []
+        for chunk in iter_table(self.diag_path, ['eid', 'diag_icd10'], self.chunk_size, sep='\t'):
+            has_code = chunk['diag_icd10'].notna().to_numpy()
+            chunk_chapters = np.full(len(chunk), -1)
+            chunk_chapters[has_code] = icd10_chapters(chunk['diag_icd10'][has_code])
+            rows = pd.DataFrame({'eid': chunk['eid'].to_numpy(), 'has_code': has_code, 'chapter': chunk_chapters})
+
+            # Participants whose rows have no ICD-10 code still get a zero count, like groupby().count() did
+            counts = rows.groupby('eid')[['has_code']].sum()
+            chapter_counts = rows[rows['chapter'] >= 0].groupby(['eid', 'chapter']).size().unstack(fill_value=0)
+            counts = counts.join(chapter_counts.reindex(columns=chapters, fill_value=0)).fillna(0)
+            partial_counts.append(counts)
+
+        # Partial counts are per chunk, a participant split between two chunks is summed here
+        counts = pd.concat(partial_counts).groupby(level=0).sum()
+        return {
+            'eid': counts.index.to_numpy(dtype=np.int32),
+            'diag_count': counts['has_code'].to_numpy(dtype=np.int32),
+            'chapter_counts': counts[list(chapters)].to_numpy(dtype=np.int32),
+            'first_diag_date': self.first_dates(counts.index),
+            'diag_signature': file_signature(self.diag_path),
+            'episodes_signature': file_signature(self.episodes_path),
+        }
+
+    def first_dates(self, eids):
+        first_dates = pd.Series(pd.NaT, index=eids, dtype='datetime64[ns]')
+        if not os.path.exists(self.episodes_path) and not os.path.exists(os.path.splitext(self.episodes_path)[0] + '.parquet'):
+            logging.warning(f"{self.episodes_path} does not exist, skipping the first diagnosis dates")
+            return first_dates.to_numpy(dtype='datetime64[D]')
+
+        logging.info(f"Finding the first episode date of {self.episodes_path}")
+        partial_dates = []
+        for chunk in iter_table(self.episodes_path, ['eid', 'epistart', 'admidate'], self.chunk_size, sep='\t'):
+            dates = pd.to_datetime(chunk['epistart'].fillna(chunk['admidate']), dayfirst=True, errors='coerce')
+            partial_dates.append(dates.groupby(chunk['eid'].to_numpy()).min())
+        if len(partial_dates) != 0:
+            episode_dates = pd.concat(partial_dates).groupby(level=0).min()
+            first_dates = episode_dates.reindex(eids).astype('datetime64[ns]')
+        return first_dates.to_numpy(dtype='datetime64[D]')
+
+    def diag_counts(self):
+        aggregates = self.load()
+        return pd.DataFrame({'eid': aggregates['eid'].astype(np.int64), 'diag_count': aggregates['diag_count'].astype(np.int64)})
+
+    def chapter_counts(self):
+        aggregates = self.load()
+        columns = [f'diag_chapter_{name}' for name in icd10_chapter_names]
+        chapter_counts = pd.DataFrame(aggregates['chapter_counts'], columns=columns)
+        chapter_counts.insert(0, 'eid', aggregates['eid'].astype(np.int64))
+        return chapter_counts
+
+    def first_diagnosis_date(self):
+        aggregates = self.load()
+        return pd.DataFrame({'eid': aggregates['eid'].astype(np.int64), 'first_diag_date': aggregates['first_diag_date']})
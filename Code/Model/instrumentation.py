@@ -0,0 +1,156 @@
+import pandas as pd
+import numpy as np
+import contextlib
+import functools
+import threading
+import logging
+import json
+import time
+import os
+
+try:
+    import resource
+except ImportError:
+    # No getrusage on Windows, the peak RSS columns are then left empty
+    resource = None
+
+trace_file = 'pipeline_trace.json'
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux, it is the peak of the process so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def frame_shape(obj):
+    # Stage inputs and outputs are frames, arrays or objects holding their frame in .df (Cohort, UKBDatasetCreator)
+    if not isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray)):
+        obj = getattr(obj, 'df', None)
+    if isinstance(obj, (pd.DataFrame, np.ndarray)) and obj.ndim == 2:
+        return obj.shape
+    if isinstance(obj, (pd.Series, np.ndarray)):
+        return len(obj), 1
+    return None, None
+
+class Tracer():
+    def __init__(self):
+        self.records = []
+        self.enabled = True
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def clear(self):
+        with self.lock:
+            self.records = []
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, data=None):
+        if not self.enabled:
+            yield {}
+            return
+        parents = self.local.__dict__.setdefault('parents', [])
+        rows_in, cols_in = frame_shape(data)
+        record = {
+            'name': name,
+            'parent': parents[-1] if parents else None,
+            'depth': len(parents),
+            'thread': threading.current_thread().name,
+            'rows_in': rows_in,
+            'cols_in': cols_in,
+            'rows_out': None,
+            'cols_out': None,
+        }
+        peak_before = peak_rss_mb()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        parents.append(name)
+        try:
+            # The caller may fill rows_out / cols_out, otherwise the shape of the input after the stage is used
+            yield record
+        finally:
+            parents.pop()
+            record['start'] = start - self.origin
+            record['wall_time'] = time.perf_counter() - start
+            # Process CPU time, it includes the other threads working at the same time
+            record['cpu_time'] = time.process_time() - cpu_start
+            peak_after = peak_rss_mb()
+            record['peak_rss_delta_mb'] = peak_after - peak_before if peak_after is not None else None
+            if record['rows_out'] is None and data is not None:
+                record['rows_out'], record['cols_out'] = frame_shape(data)
+            with self.lock:
+                self.records.append(record)
+            logging.debug(f"{name} took {record['wall_time']:.3f}s")
+
+    @contextlib.contextmanager
+    def capture(self):
+        # Takes the records of the stages run in the block out of this tracer, so a worker process can send them
+        # back with its result. perf_counter is shared by the processes, the starts are kept in its absolute time
+        with self.lock:
+            first = len(self.records)
+        captured = []
+        try:
+            yield captured
+        finally:
+            with self.lock:
+                records = self.records[first:]
+                del self.records[first:]
+            captured.extend({**record, 'start': record['start'] + self.origin, 'pid': os.getpid()} for record in records)
+
+    def merge(self, records):
+        # Adds the captured records of a worker to the trace of this process
+        with self.lock:
+            self.records.extend({**record, 'start': record['start'] - self.origin} for record in records)
+
+    def traced(self, name=None, data_arg=0):
+        # data_arg is the position of the argument whose shape is recorded, 0 is self for methods
+        def decorator(func):
+            stage_name = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                data = args[data_arg] if data_arg is not None and len(args) > data_arg else None
+                with self.stage(stage_name, data) as record:
+                    result = func(*args, **kwargs)
+                    if record and result is not None:
+                        record['rows_out'], record['cols_out'] = frame_shape(result)
+                    return result
+            return wrapper
+        return decorator
+
+    def summary(self):
+        columns = ['name', 'calls', 'wall_time', 'cpu_time', 'peak_rss_delta_mb', 'rows_in', 'cols_in', 'rows_out', 'cols_out']
+        if len(self.records) == 0:
+            return pd.DataFrame(columns=columns)
+        records = pd.DataFrame(self.records)
+        summary = records.groupby('name', sort=False).agg(
+            calls=('name', 'size'), wall_time=('wall_time', 'sum'), cpu_time=('cpu_time', 'sum'),
+            peak_rss_delta_mb=('peak_rss_delta_mb', 'max'), rows_in=('rows_in', 'last'), cols_in=('cols_in', 'last'),
+            rows_out=('rows_out', 'last'), cols_out=('cols_out', 'last'))
+        summary = summary.reset_index()[columns].sort_values('wall_time', ascending=False, ignore_index=True)
+        return summary.astype({column: 'Int64' for column in ['rows_in', 'cols_in', 'rows_out', 'cols_out']})
+
+    def print_summary(self):
+        print(self.summary().to_string(index=False, float_format=lambda value: f'{value:.3f}'))
+
+    def save(self, path=trace_file):
+        # Chrome trace event format, the file opens in chrome://tracing or Perfetto
+        events = []
+        for record in self.records:
+            events.append({
+                'name': record['name'],
+                'ph': 'X',
+                'ts': record['start'] * 1e6,
+                'dur': record['wall_time'] * 1e6,
+                'pid': record.get('pid', os.getpid()),
+                'tid': record['thread'],
+                'args': {key: value for key, value in record.items() if key not in ('name', 'start', 'wall_time', 'thread', 'pid')},
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f, indent=1, default=str)
+        logging.info(f"Saved the pipeline trace to {path}")
+
+tracer = Tracer()
+traced = tracer.traced
+trace_stage = tracer.stage
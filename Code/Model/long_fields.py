@@ -0,0 +1,79 @@
+import pandas as pd
+import numpy as np
+import os
+
+long_fields_file = "dataset_long.parquet"
+
+# Fields with several instances / array entries that are kept in full, in the long store only
+multi_instance_fields = [
+    40006,  # Type of cancer: ICD10
+    41272,  # Operative procedures - OPCS4
+    41270,  # Diagnoses - ICD10 (HES summary)
+]
+
+long_columns = ['eid', 'field', 'instance', 'array', 'value']
+
+def parse_column(column):
+    # "41272-0.3" is field 41272, instance 0, array entry 3
+    field, position = column.split('-')
+    instance, array = position.split('.')
+    return int(field), int(instance), int(array)
+
+def melt_columns(df, columns):
+    # Only the cells with a value become rows, the wide frame is never stacked as a whole
+    if len(columns) == 0 or len(df) == 0:
+        return empty_long_values()
+    positions = np.array([parse_column(column) for column in columns])
+    values = df[columns].to_numpy(dtype=object)
+    rows, cols = np.nonzero(pd.notna(values))
+    return pd.DataFrame({
+        'eid': df['eid'].to_numpy(dtype=np.int64)[rows],
+        'field': positions[cols, 0].astype(np.int32),
+        'instance': positions[cols, 1].astype(np.int16),
+        'array': positions[cols, 2].astype(np.int16),
+        'value': values[rows, cols].astype(str),
+    })
+
+def field_columns(columns, fields):
+    fields = {str(field) for field in fields}
+    return [column for column in columns if '-' in str(column) and str(column).split('-')[0] in fields]
+
+def empty_long_values():
+    return pd.DataFrame({
+        'eid': np.zeros(0, dtype=np.int64),
+        'field': np.zeros(0, dtype=np.int32),
+        'instance': np.zeros(0, dtype=np.int16),
+        'array': np.zeros(0, dtype=np.int16),
+        'value': np.zeros(0, dtype=object),
+    })
+
+class LongStoreWriter():
+    def __init__(self, path=long_fields_file):
+        import pyarrow as pa
+        self.path = path
+        self.schema = pa.schema([('eid', pa.int64()), ('field', pa.int32()), ('instance', pa.int16()),
+                                 ('array', pa.int16()), ('value', pa.string())])
+        self.writer = None
+        self.num_rows = 0
+
+    def write(self, long_values):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path + '.tmp', self.schema)
+        if len(long_values) != 0:
+            self.writer.write_table(pa.Table.from_pandas(long_values[long_columns], schema=self.schema, preserve_index=False))
+            self.num_rows += len(long_values)
+
+    def close(self):
+        if self.writer is None:
+            self.write(empty_long_values())
+        self.writer.close()
+        os.replace(self.path + '.tmp', self.path)
+
+def read_long_values(path, fields=None, eids=None):
+    filters = [('field', 'in', [int(field) for field in fields])] if fields is not None else None
+    long_values = pd.read_parquet(path, filters=filters)
+    if eids is not None:
+        long_values = long_values[np.isin(long_values['eid'].to_numpy(), np.asarray(eids))]
+    return long_values.reset_index(drop=True)
@@ -1,14 +1,96 @@
 import matplotlib.pyplot as plt
+import multiprocessing
 import xgboost as xgb
+import pandas as pd
 import numpy as np
+import tempfile
+import shutil
+import queue
+import time
+import os
 
-from sklearn.metrics import accuracy_score, f1_score
-from sklearn.linear_model import LogisticRegression
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.neural_network import MLPClassifier
 from catboost import CatBoostClassifier
+from threadpoolctl import threadpool_limits
+from sklearn.base import clone
 from sklearn.svm import SVC
 
+from instrumentation import trace_stage, tracer
+from fold_cache import create_fold_cache
+
+# Name of the threading parameter of the models that fit on several cores, the others get a single core
+thread_params = {
+    'CatBoost': 'thread_count',
+    'XGBoost': 'n_jobs',
+    'Random Forest': 'n_jobs',
+}
+
+# Fitted out of core in place of the models of the same name, logistic regression has no partial_fit
+out_of_core_models = {
+    'Logistic Regression': SGDClassifier(loss='log_loss'),
+}
+
+def fit_model(name, model, cpu_budget, X_train, y_train, X_test):
+    if name in thread_params:
+        model.set_params(**{thread_params[name]: cpu_budget})
+    # Also caps the BLAS / OpenMP threads of the sklearn models
+    with tracer.capture() as records, threadpool_limits(limits=cpu_budget):
+        start = time.perf_counter()
+        with trace_stage(f'{name}.fit', X_train):
+            model.fit(X_train, y_train)
+        fit_time = time.perf_counter() - start
+        with trace_stage(f'{name}.predict', X_test):
+            y_pred = model.predict(X_test)
+    # The stages ran in a pool worker, the parent merges them into its trace
+    return name, model, y_pred, fit_time, records
+
+# Set once per worker process by the pool initializer, the fold cache maps the cohort instead of pickling it
+cv_worker_data = {}
+
+def init_cv_worker(fold_cache):
+    cv_worker_data['fold_cache'] = fold_cache
+
+def ranking_scores(model, X):
+    # SVC has no predict_proba unless it was created with probability=True, its margins rank just as well
+    if hasattr(model, 'predict_proba'):
+        return model.predict_proba(X)[:, 1]
+    return model.decision_function(X)
+
+def score_fold(name, model, cpu_budget, fold, fold_cache=None):
+    fold_cache = fold_cache or cv_worker_data['fold_cache']
+    X_train, y_train, X_test, y_test = fold_cache.fold(fold)
+    model = clone(model)
+    if name in thread_params:
+        model.set_params(**{thread_params[name]: cpu_budget})
+    with tracer.capture() as records, threadpool_limits(limits=cpu_budget):
+        start = time.perf_counter()
+        with trace_stage(f'{name}.fit', X_train):
+            # CatBoost and XGBoost fit on the fold's quantized data, it is built once per fold
+            fold_cache.quantized().fit(model, f'fold{fold}_train', X_train, y_train)
+        fit_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with trace_stage(f'{name}.predict', X_test):
+            y_pred = model.predict(X_test)
+        predict_time = time.perf_counter() - start
+        y_scores = ranking_scores(model, X_test)
+
+    return {
+        'model': name,
+        'fold': fold,
+        'accuracy': accuracy_score(y_test, y_pred),
+        'f1_score': f1_score(y_test, y_pred),
+        'roc_auc': roc_auc_score(y_test, y_scores),
+        'fit_time': fit_time,
+        # Microseconds per predicted row
+        'predict_latency_us': predict_time / len(y_test) * 1e6,
+        'trace': records,
+    }
+
 class ModelSelector:
     def __init__(self):
         self.models = {
@@ -20,24 +102,178 @@ class ModelSelector:
                           'Random Forest': RandomForestClassifier()
                       }
         self.results = {}
+        self.timed_out = []
+        self.cv_results = None
         self.best_model = None
         self.best_score = 0
         self.best_model_name = None
 
-    def train_models(self, X_train, y_train, X_test, y_test):
+    def train_models(self, X_train, y_train, X_test, y_test, parallel=False, n_jobs=None, timeout=None):
+        if parallel:
+            self.train_models_parallel(X_train, y_train, X_test, y_test, n_jobs, timeout)
+            return
+
         for name, model in self.models.items():
             print(f'Training {name} model')
-            model.fit(X_train, y_train)
-            y_pred = model.predict(X_test)
+            start = time.perf_counter()
+            with trace_stage(f'{name}.fit', X_train):
+                model.fit(X_train, y_train)
+            fit_time = time.perf_counter() - start
+            with trace_stage(f'{name}.predict', X_test):
+                y_pred = model.predict(X_test)
             
-            self.save_results(name, y_test, y_pred)
+            self.save_results(name, y_test, y_pred, fit_time)
             self.update_best_model(name, model)
         print(f'Finished training, best model is {self.best_model_name}')
 
-    def save_results(self, model_name, y_test, y_pred):
+    def train_models_out_of_core(self, store, epochs=None):
+        # Streams the batches of the on-disk cohort, the train / test split is given by the hash of the eids
+        # Imported here, out_of_core pulls in the cohort and HES modules that in-memory training does not need
+        from out_of_core import can_fit_out_of_core, fit_out_of_core, predict_out_of_core, partial_fit_epochs
+        epochs = epochs or partial_fit_epochs
+        work_dir = tempfile.mkdtemp(prefix='out_of_core_')
+        try:
+            for name, model in self.models.items():
+                model = clone(out_of_core_models.get(name, model))
+                if not can_fit_out_of_core(model):
+                    print(f'{name} model can only be trained in memory, leaving it out of the comparison')
+                    continue
+                print(f'Training {name} model out of core')
+                start = time.perf_counter()
+                with trace_stage(f'{name}.fit_out_of_core'):
+                    model = fit_out_of_core(name, model, store, work_dir, epochs)
+                fit_time = time.perf_counter() - start
+                with trace_stage(f'{name}.predict_out_of_core'):
+                    y_test, y_pred = predict_out_of_core(model, store)
+
+                self.save_results(name, y_test, y_pred, fit_time)
+                self.update_best_model(name, model)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print(f'Finished training, best model is {self.best_model_name}')
+
+    def cpu_budgets(self, n_jobs=None):
+        num_cpus = n_jobs or os.cpu_count()
+        threaded = [name for name in self.models if name in thread_params]
+        num_single = len(self.models) - len(threaded)
+        # Never below one core per model, so with fewer cores than models the machine is shared
+        spare = max(len(threaded), num_cpus - num_single)
+        budgets = {name: 1 for name in self.models}
+        for i, name in enumerate(threaded):
+            budgets[name] = spare // len(threaded) + (1 if i < spare % len(threaded) else 0)
+        return budgets
+
+    def train_models_parallel(self, X_train, y_train, X_test, y_test, n_jobs=None, timeout=None):
+        budgets = self.cpu_budgets(n_jobs)
+        # timeout is either one number of seconds for every model or a dict of seconds per model name
+        timeouts = timeout if isinstance(timeout, dict) else {name: timeout for name in self.models}
+        finished = queue.Queue()
+        self.timed_out = []
+
+        pool = multiprocessing.Pool(processes=len(self.models))
+        try:
+            start = time.monotonic()
+            for name, model in self.models.items():
+                print(f'Training {name} model on {budgets[name]} cores')
+                pool.apply_async(fit_model, (name, model, budgets[name], X_train, y_train, X_test),
+                                 callback=finished.put, error_callback=lambda error, name=name: finished.put((name, error)))
+
+            pending = set(self.models)
+            while pending:
+                # Wakes up at the earliest deadline, models without a timeout do not hold back the others
+                deadlines = [start + timeouts[name] for name in pending if timeouts.get(name) is not None]
+                wait = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+                try:
+                    result = finished.get(timeout=wait)
+                except queue.Empty:
+                    result = None
+
+                # A result that arrives after the deadline of its model is dropped like one that never arrived
+                for name in list(pending):
+                    if timeouts.get(name) is not None and time.monotonic() - start >= timeouts[name]:
+                        pending.discard(name)
+                        self.timed_out.append(name)
+                        print(f'{name} model timed out after {timeouts[name]}s, leaving it out of the comparison')
+
+                if result is None or result[0] not in pending:
+                    continue
+                if len(result) == 2:
+                    name, error = result
+                    pending.discard(name)
+                    print(f'{name} model failed - {error}')
+                else:
+                    name, model, y_pred, fit_time, records = result
+                    tracer.merge(records)
+                    pending.discard(name)
+                    self.models[name] = model
+                    self.save_results(name, y_test, y_pred, fit_time)
+                    print(f'Finished training {name} model in {fit_time:.1f}s')
+        finally:
+            # Also stops the fits that timed out
+            pool.terminate()
+            pool.join()
+
+        for name in self.models:
+            if name in self.results:
+                self.update_best_model(name, self.models[name])
+        print(f'Finished training, best model is {self.best_model_name}')
+
+    def cross_validate_models(self, X, y, cv=5, parallel=False, n_jobs=None, random_state=42, cache_dir=None, refit=True):
+        # Every model is scored on the same folds, the cohort is split and converted to numpy only once
+        fold_cache = create_fold_cache(X, y, cv, random_state, cache_dir)
+        num_cpus = n_jobs or os.cpu_count()
+        tasks = [(name, fold) for name in self.models for fold in range(cv)]
+        fold_results = []
+        try:
+            if parallel:
+                num_workers = max(1, min(num_cpus, len(tasks)))
+                cpu_budget = max(1, num_cpus // num_workers)
+                print(f'Cross validating {len(self.models)} models on {cv} folds with {num_workers} workers')
+                with ProcessPoolExecutor(max_workers=num_workers, initializer=init_cv_worker,
+                                         initargs=(fold_cache,)) as executor:
+                    futures = [executor.submit(score_fold, name, self.models[name], cpu_budget, fold)
+                               for name, fold in tasks]
+                    for future in as_completed(futures):
+                        result = future.result()
+                        tracer.merge(result.pop('trace'))
+                        fold_results.append(result)
+                        print(f"Finished {result['model']} fold {result['fold']}")
+            else:
+                for name, fold in tasks:
+                    print(f'Training {name} model on fold {fold}')
+                    result = score_fold(name, self.models[name], num_cpus, fold, fold_cache)
+                    tracer.merge(result.pop('trace'))
+                    fold_results.append(result)
+        finally:
+            if cache_dir is None:
+                fold_cache.remove()
+
+        fold_results = pd.DataFrame(fold_results)
+        summary = fold_results.drop(columns=['fold']).groupby('model', sort=False).agg(['mean', 'std'])
+        summary.columns = [f'{metric}_{stat}' for metric, stat in summary.columns]
+        self.cv_results = summary.reindex(list(self.models))
+
+        for name, row in self.cv_results.iterrows():
+            self.results[name] = {
+                'accuracy': row['accuracy_mean'],
+                'f1_score': row['f1_score_mean'],
+                'fit_time': row['fit_time_mean'],
+            }
+            if row['accuracy_mean'] > self.best_score:
+                self.best_score = row['accuracy_mean']
+                self.best_model_name = name
+
+        if refit:
+            print(f'Refitting {self.best_model_name} on the whole cohort')
+            self.best_model = clone(self.models[self.best_model_name]).fit(X, y)
+        print(f'Finished cross validation, best model is {self.best_model_name}')
+        return self.cv_results
+
+    def save_results(self, model_name, y_test, y_pred, fit_time=None):
         self.results[model_name] = {
             'accuracy': accuracy_score(y_test, y_pred),
             'f1_score': f1_score(y_test, y_pred),
+            'fit_time': fit_time,
         }
         
     def update_best_model(self, name, model):
@@ -52,6 +288,11 @@ class ModelSelector:
             print(f'model: {name}')
             print('accuracy: ', metrics['accuracy'])
             print('f1 score: ', metrics['f1_score'])
+            if metrics.get('fit_time') is not None:
+                print(f"fit time: {metrics['fit_time']:.1f}s")
+            print()
+        for name in self.timed_out:
+            print(f'model: {name} timed out')
             print()
 
     def plot_results(self):
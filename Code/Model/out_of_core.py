@@ -0,0 +1,194 @@
+import pyarrow.parquet as pq
+import xgboost as xgb
+import pyarrow as pa
+import numpy as np
+import argparse
+import os
+
+from catboost import CatBoostClassifier, Pool
+from catboost.utils import quantize
+from sklearn.preprocessing import StandardScaler, FunctionTransformer
+from sklearn.pipeline import Pipeline
+
+from create_cohort import Cohort, dataset_path
+from hes_aggregation import HESAggregator
+from dtype_schema import apply_schema
+from instrumentation import traced
+from utils import *
+
+cohort_store_path = "Dataset/cohort_store.parquet"
+store_chunk_size = 50000
+batch_size = 50000
+# Resolution of the eid hash split, a test size of 0.3 keeps the eids whose hash falls in 3000 of the buckets
+hash_buckets = 10000
+partial_fit_epochs = 5
+uint64_mask = (1 << 64) - 1
+
+def eid_hash(eids, seed=42):
+    # splitmix64, the split of a participant only depends on its eid and never on the other rows of the file
+    x = np.asarray(eids, dtype=np.uint64) + np.uint64((seed * 0x9E3779B97F4A7C15) & uint64_mask)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def is_test_eid(eids, test_size=0.3, seed=42):
+    return eid_hash(eids, seed) % np.uint64(hash_buckets) < np.uint64(round(test_size * hash_buckets))
+
+@traced()
+def write_cohort_store(path=cohort_store_path, chunk_size=store_chunk_size, drop_cols=None):
+    # The cohort of every female participant, without sampling the controls, built one dataset chunk at a time
+    diag_counts = HESAggregator().diag_counts()
+    tmp_path = f'{path}.tmp'
+    writer = None
+    num_rows = 0
+    try:
+        for chunk in iter_table(dataset_path, None, chunk_size, index_col=0):
+            cohort = Cohort(df=apply_schema(chunk))
+            cohort.drop_male_patients()
+            cohort.create_labels()
+            cohort.preprocess_cat_features()
+            cohort.add_estrogen_exposure_col()
+            cohort.add_num_diagnoses_col(diag_counts)
+            if drop_cols:
+                cohort.drop_cols(drop_cols)
+            cohort.split_x_y()
+
+            columns = {'eid': pa.array(cohort.X.index.to_numpy(dtype=np.int64)),
+                       'has_endo': pa.array(cohort.y.to_numpy(dtype=np.int8))}
+            for column in cohort.X.columns:
+                columns[column] = pa.array(cohort.X[column].to_numpy(dtype=np.float32))
+            table = pa.table(columns)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            num_rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(tmp_path, path)
+    logging.info(f"Wrote the {num_rows} participants of the cohort to {path}")
+
+class CohortStore():
+    def __init__(self, path=cohort_store_path, test_size=0.3, seed=42, batch_size=batch_size):
+        self.path = path
+        self.test_size = test_size
+        self.seed = seed
+        self.batch_size = batch_size
+        self.features = [name for name in pq.read_schema(path).names if name not in ('eid', 'has_endo')]
+
+    def batches(self, split=None):
+        # split is 'train', 'test' or None for every row, only one batch of the file is in memory at a time
+        parquet_file = pq.ParquetFile(self.path)
+        for batch in parquet_file.iter_batches(batch_size=self.batch_size):
+            eids = batch.column('eid').to_numpy()
+            rows = slice(None)
+            if split is not None:
+                rows = is_test_eid(eids, self.test_size, self.seed) == (split == 'test')
+            X = np.column_stack([batch.column(name).to_numpy(zero_copy_only=False) for name in self.features])
+            yield X[rows].astype(np.float32, copy=False), batch.column('has_endo').to_numpy()[rows], eids[rows]
+
+class BatchIter(xgb.DataIter):
+    def __init__(self, store, split, cache_prefix):
+        super().__init__(cache_prefix=cache_prefix)
+        self.store = store
+        self.split = split
+        self.iterator = None
+
+    def next(self, input_data):
+        if self.iterator is None:
+            self.iterator = self.store.batches(self.split)
+        batch = next(self.iterator, None)
+        if batch is None:
+            return 0
+        X, y, _ = batch
+        input_data(data=X, label=y, feature_names=self.store.features)
+        return 1
+
+    def reset(self):
+        self.iterator = None
+
+def fit_xgboost(model, store, work_dir):
+    # External memory, XGBoost pages the histogram matrix of the batches to the cache directory
+    train_data = xgb.DMatrix(BatchIter(store, 'train', os.path.join(work_dir, 'xgboost')))
+    booster = xgb.train({**model.get_xgb_params(), 'tree_method': 'hist'}, train_data, model.get_num_boosting_rounds())
+    model.load_model(booster.save_raw('ubj'))
+    return model
+
+def fit_catboost(model, store, work_dir, used_ram_limit=None):
+    # The batches are streamed to a TSV file, CatBoost quantizes it from disk into a pool file of one byte per value
+    data_path = os.path.join(work_dir, 'catboost_train.tsv')
+    cd_path = os.path.join(work_dir, 'catboost_train.cd')
+    with open(cd_path, 'w') as f:
+        f.write('0\tLabel\n')
+    with open(data_path, 'w', newline='') as f:
+        for i, (X, y, _) in enumerate(store.batches('train')):
+            batch = pd.DataFrame(X, columns=store.features)
+            batch.insert(0, 'has_endo', y)
+            batch.to_csv(f, sep='\t', header=(i == 0), index=False, na_rep='nan')
+
+    pool = quantize(data_path, column_description=cd_path, has_header=True, used_ram_limit=used_ram_limit)
+    pool_path = os.path.join(work_dir, 'catboost_train.cbp')
+    pool.save(pool_path)
+    del pool
+    os.remove(data_path)
+    return model.fit(Pool(f'quantized://{pool_path}'))
+
+def fit_incremental(model, store, epochs=partial_fit_epochs):
+    # One pass for the scaling statistics, NaNs are ignored by the scaler and then filled with the (scaled) mean
+    scaler = StandardScaler()
+    for X, _, _ in store.batches('train'):
+        scaler.partial_fit(X)
+    pipeline = Pipeline([('scale', scaler), ('fill', FunctionTransformer(np.nan_to_num)), ('model', model)])
+
+    for epoch in range(epochs):
+        for X, y, _ in store.batches('train'):
+            model.partial_fit(np.nan_to_num(scaler.transform(X)), y, classes=np.array([0, 1]))
+    return pipeline
+
+def can_fit_out_of_core(model):
+    return isinstance(model, (xgb.XGBClassifier, CatBoostClassifier)) or hasattr(model, 'partial_fit')
+
+def fit_out_of_core(name, model, store, work_dir, epochs=partial_fit_epochs):
+    if isinstance(model, xgb.XGBClassifier):
+        return fit_xgboost(model, store, work_dir)
+    if isinstance(model, CatBoostClassifier):
+        return fit_catboost(model, store, work_dir)
+    if hasattr(model, 'partial_fit'):
+        return fit_incremental(model, store, epochs)
+    raise ValueError(f"{name} can only be fitted in memory")
+
+def predict_out_of_core(model, store):
+    y_test, y_pred = [], []
+    for X, y, _ in store.batches('test'):
+        if len(y) == 0:
+            continue
+        y_test.append(y)
+        y_pred.append(model.predict(X))
+    return np.concatenate(y_test), np.concatenate(y_pred).astype(int)
+
+def main():
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Train the models from the on-disk cohort of every female participant")
+    parser.add_argument('--store', default=cohort_store_path)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="Write the cohort store from the dataset in chunks")
+    build_parser.add_argument('--chunk-size', type=int, default=store_chunk_size)
+    train_parser = subparsers.add_parser('train', help="Stream the cohort store through the models")
+    train_parser.add_argument('--batch-size', type=int, default=batch_size)
+    train_parser.add_argument('--test-size', type=float, default=0.3)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        # best_estimator imports the whole search, only its list of dropped features is needed here
+        from best_estimator import cohort_drop_features
+        write_cohort_store(args.store, args.chunk_size, [feature_to_code(feature) for feature in cohort_drop_features])
+        return
+
+    # model_selection imports this module for its out-of-core training
+    from model_selection import ModelSelector
+    selector = ModelSelector()
+    selector.train_models_out_of_core(CohortStore(args.store, args.test_size, batch_size=args.batch_size))
+    selector.print_results()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import xgboost as xgb
+import numpy as np
+import shutil
+import os
+
+from catboost import CatBoostClassifier, Pool
+
+# The library defaults, a model fitted on the quantized data is the same as one fitted on the raw features
+catboost_border_count = 254
+xgboost_max_bin = 256
+
+class QuantizedData():
+    def __init__(self, cache_dir, border_count=catboost_border_count, max_bin=xgboost_max_bin):
+        self.cache_dir = cache_dir
+        self.border_count = border_count
+        self.max_bin = max_bin
+        self.pools = {}
+        self.matrices = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # Only the directory is sent to worker processes, they bin their own pools with the saved borders
+        return {'cache_dir': self.cache_dir, 'border_count': self.border_count, 'max_bin': self.max_bin,
+                'pools': {}, 'matrices': {}}
+
+    def borders_path(self, name):
+        return os.path.join(self.cache_dir, f'{name}_borders.tsv')
+
+    def catboost_pool(self, name, X, y, reference=None):
+        # The borders are searched once and saved, every process bins its pool with them once
+        if name not in self.pools:
+            borders_path = self.borders_path(reference or name)
+            pool = Pool(X, np.asarray(y))
+            if os.path.exists(borders_path):
+                pool.quantize(input_borders=borders_path)
+            elif reference is not None:
+                raise KeyError(f"The borders of {reference} were not computed yet")
+            else:
+                pool.quantize(border_count=self.border_count)
+                tmp_path = f'{borders_path}.{os.getpid()}.tmp'
+                pool.save_quantization_borders(tmp_path)
+                os.replace(tmp_path, borders_path)
+            self.pools[name] = pool
+        return self.pools[name]
+
+    def xgboost_matrix(self, name, X, y, reference=None):
+        # XGBoost can only save plain DMatrix objects, the quantile matrix is kept once per process
+        if name not in self.matrices:
+            ref = self.matrices[reference] if reference is not None else None
+            self.matrices[name] = xgb.QuantileDMatrix(X, np.asarray(y), max_bin=self.max_bin, ref=ref)
+        return self.matrices[name]
+
+    def is_quantizable(self, model):
+        params = model.get_params()
+        if isinstance(model, CatBoostClassifier):
+            return params.get('border_count') in (None, self.border_count)
+        if isinstance(model, xgb.XGBClassifier):
+            return params.get('max_bin') in (None, self.max_bin)
+        return False
+
+    def fit(self, model, name, X, y):
+        if not self.is_quantizable(model):
+            return model.fit(X, y)
+        if isinstance(model, CatBoostClassifier):
+            return model.fit(self.catboost_pool(name, X, y))
+        booster = xgb.train(model.get_xgb_params(), self.xgboost_matrix(name, X, y), model.get_num_boosting_rounds())
+        model.load_model(booster.save_raw('ubj'))
+        return model
+
+    def release(self):
+        self.pools = {}
+        self.matrices = {}
+
+    def remove(self):
+        self.release()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
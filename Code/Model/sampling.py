@@ -0,0 +1,54 @@
+import pandas as pd
+import numpy as np
+import logging
+
+class StratifiedSampler():
+    def __init__(self, ratio=1.0, match_on=None, random_state=42):
+        # ratio is the number of controls per case, match_on maps a column to the width of its bands (None for
+        # categorical columns such as the assessment centre), controls are drawn within each combination of bands
+        self.ratio = ratio
+        self.match_on = dict(match_on or {})
+        self.random_state = random_state
+
+    def params(self):
+        return {'ratio': self.ratio, 'match_on': self.match_on, 'random_state': self.random_state}
+
+    def strata(self, df):
+        if len(self.match_on) == 0:
+            return np.zeros(len(df), dtype=np.int64)
+        strata = np.zeros(len(df), dtype=np.int64)
+        for column, band_width in self.match_on.items():
+            values = df[column].to_numpy()
+            if band_width is not None:
+                values = np.floor(values.astype(float) / band_width)
+            # Missing values get a stratum of their own
+            codes, uniques = pd.factorize(values, use_na_sentinel=False)
+            strata, _ = pd.factorize(strata * len(uniques) + codes)
+        return strata
+
+    def select(self, labels, strata):
+        # Returns the sorted positions of every case and of the drawn controls, the frame is never copied
+        labels = np.asarray(labels)
+        cases = np.flatnonzero(labels == 1)
+        controls = np.flatnonzero(labels == 0)
+        num_strata = strata.max() + 1 if len(strata) != 0 else 0
+
+        quotas = np.floor(np.bincount(strata[cases], minlength=num_strata) * self.ratio).astype(np.int64)
+        available = np.bincount(strata[controls], minlength=num_strata)
+        if np.any(quotas > available):
+            logging.warning(f"Only {np.minimum(quotas, available).sum()} of {quotas.sum()} controls are available "
+                            f"in their strata, taking all of them")
+
+        # Shuffle the controls with a seeded key inside their stratum and keep the first quota of every stratum
+        rng = np.random.default_rng(self.random_state)
+        control_strata = strata[controls]
+        order = np.lexsort((rng.random(len(controls)), control_strata))
+        sorted_strata = control_strata[order]
+        stratum_starts = np.searchsorted(sorted_strata, np.arange(num_strata))
+        rank = np.arange(len(order)) - stratum_starts[sorted_strata]
+        chosen = controls[order[rank < quotas[sorted_strata]]]
+
+        return np.sort(np.concatenate([cases, chosen]))
+
+    def sample(self, df, label_column):
+        return self.select(df[label_column].to_numpy(), self.strata(df))
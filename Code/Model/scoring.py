@@ -0,0 +1,155 @@
+import numpy as np
+import argparse
+import json
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from catboost import CatBoostClassifier
+
+from features_preprocess import encoding_source_codes, prefix_fields
+from long_fields import melt_columns, field_columns
+from hes_aggregation import HESAggregator
+from instrumentation import traced
+from create_cohort import Cohort
+from utils import *
+
+model_file = 'model.cbm'
+score_chunk_size = 100000
+
+def export_model(search, path=model_file):
+    # Only the refitted CatBoost model is kept, in its native format, the search object is not needed to score
+    search.best_estimator_.save_model(path)
+    logging.info(f"Exported the best model to {path}")
+
+class Scorer:
+    def __init__(self, model_path=model_file, diag_counts=None):
+        self.model = CatBoostClassifier()
+        self.model.load_model(model_path)
+        self.features = list(self.model.feature_names_)
+        # Raw columns the cohort pipeline reads, a record without them is scored as if they were empty
+        self.source_codes = encoding_source_codes() + [feature_to_code("menarche"), feature_to_code("Age at menopause")]
+        self.column_names = {}
+
+        if diag_counts is None:
+            diag_counts = self.load_diag_counts()
+        self.diag_eids = diag_counts['eid'].to_numpy()
+        self.diag_counts = diag_counts['diag_count'].to_numpy()
+
+    def load_diag_counts(self):
+        try:
+            return HESAggregator().diag_counts()
+        except Exception as ee:
+            logging.warning(f"Cannot load the HES diagnoses, participants are scored without them - {ee}")
+            return pd.DataFrame({'eid': np.zeros(0, dtype=np.int64), 'diag_count': np.zeros(0, dtype=np.int64)})
+
+    def records_diag_counts(self, eids):
+        # Only the rows of the scored participants are merged, the HES eids are sorted by the aggregation
+        eids = np.unique(eids)
+        positions = np.minimum(np.searchsorted(self.diag_eids, eids), max(len(self.diag_eids) - 1, 0))
+        matched = self.diag_eids[positions] == eids if len(self.diag_eids) != 0 else np.zeros(len(eids), dtype=bool)
+        return pd.DataFrame({'eid': eids[matched], 'diag_count': self.diag_counts[positions[matched]]})
+
+    def feature_names(self, columns):
+        key = tuple(columns)
+        if key not in self.column_names:
+            self.column_names[key] = codes_to_features(columns)
+        return self.column_names[key]
+
+    def prepare(self, df):
+        # The same encoding and derived columns as Cohort.create_cohort, without the cohort selection
+        df = df.reindex(columns=list(df.columns) + [code for code in self.source_codes if code not in df.columns])
+        eids = df['eid'].to_numpy(dtype=np.int64)
+        cohort = Cohort(df=df, long_fields_path=None)
+        # Records may carry every instance of the coded fields ("40006-2.0"), they are encoded like the long store
+        cohort.long_values = melt_columns(df, field_columns(df.columns, prefix_fields()))
+        cohort.preprocess_cat_features()
+        cohort.add_estrogen_exposure_col()
+        cohort.add_num_diagnoses_col(self.records_diag_counts(eids))
+
+        X = cohort.df
+        X.columns = self.feature_names(X.columns)
+        return X.reindex(columns=self.features).to_numpy(dtype=np.float32)
+
+    @traced('Scorer.score_batch', data_arg=1)
+    def score_batch(self, df):
+        return self.model.predict_proba(self.prepare(df))[:, 1]
+
+    def score_record(self, record):
+        return float(self.score_batch(pd.DataFrame([record]))[0])
+
+    def score_file(self, path, output_path, chunk_size=score_chunk_size):
+        start = time.perf_counter()
+        num_rows = 0
+        with open(output_path, 'w', newline='') as f:
+            for i, chunk in enumerate(iter_table(path, None, chunk_size, index_col=0)):
+                scores = pd.DataFrame({'eid': chunk['eid'].to_numpy(), 'endo_probability': self.score_batch(chunk)})
+                scores.to_csv(f, header=(i == 0), index=False)
+                num_rows += len(chunk)
+        elapsed = time.perf_counter() - start
+        logging.info(f"Scored {num_rows} participants in {elapsed:.2f}s ({elapsed / max(num_rows, 1) * 1e6:.0f}us per row)")
+
+def make_handler(scorer):
+    class ScoreHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok', 'features': len(scorer.features)})
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                # A single record is one JSON object, a batch is a list of them
+                if isinstance(body, dict):
+                    self.send_json(200, {'endo_probability': scorer.score_record(body)})
+                else:
+                    self.send_json(200, {'endo_probability': scorer.score_batch(pd.DataFrame(body)).tolist()})
+            except Exception as ee:
+                self.send_json(400, {'error': str(ee)})
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return ScoreHandler
+
+def serve(scorer, host='127.0.0.1', port=8080):
+    server = HTTPServer((host, port), make_handler(scorer))
+    logging.info(f"Scoring on http://{host}:{port}/score")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def main():
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Score UKB participants with the exported model")
+    parser.add_argument('--model', default=model_file)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    batch_parser = subparsers.add_parser('batch', help="Score a dataset file with the columns of dataset_all.csv")
+    batch_parser.add_argument('input')
+    batch_parser.add_argument('output')
+    batch_parser.add_argument('--chunk-size', type=int, default=score_chunk_size)
+    serve_parser = subparsers.add_parser('serve', help="Serve single records and small batches over HTTP")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    scorer = Scorer(args.model)
+    if args.command == 'batch':
+        scorer.score_file(args.input, args.output, args.chunk_size)
+    else:
+        serve(scorer, args.host, args.port)
+
+if __name__ == "__main__":
+    main()
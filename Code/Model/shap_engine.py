@@ -0,0 +1,193 @@
+import numpy as np
+import argparse
+import shutil
+import shap
+import json
+import time
+import os
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from catboost import CatBoostClassifier
+
+from instrumentation import traced, tracer
+from best_estimator import load_cohort
+from scoring import model_file
+from utils import *
+
+shap_dir = 'shap_values'
+shap_meta = 'shap.json'
+shap_chunk_size = 5000
+# Rows read at once by the summaries, the values array is never loaded whole
+summary_chunk_size = 100000
+# Largest difference allowed between the sum of the SHAP values of a row and its raw prediction
+additivity_tolerance = 1e-3
+
+# Set once per worker process by the pool initializer, the model and the arrays are opened from disk
+worker_state = {}
+
+def init_worker(model_path, output_dir, thread_count):
+    model = CatBoostClassifier(thread_count=thread_count)
+    model.load_model(model_path)
+    worker_state['model'] = model
+    worker_state['explainer'] = shap.TreeExplainer(model)
+    worker_state['X'] = np.load(os.path.join(output_dir, 'X.npy'), mmap_mode='r')
+    worker_state['values'] = np.load(os.path.join(output_dir, 'values.npy'), mmap_mode='r+')
+
+def explain_chunk(start, stop):
+    X = np.asarray(worker_state['X'][start:stop])
+    values = worker_state['explainer'].shap_values(X)
+    # Older shap versions return one array per class for binary CatBoost models
+    if isinstance(values, list):
+        values = values[-1]
+    output = worker_state['values']
+    output[start:stop] = values
+    output.flush()
+
+    # The SHAP values of a row add up to its raw prediction, checked on every chunk as in the notebook
+    raw = worker_state['model'].predict(X, prediction_type='RawFormulaVal')
+    base_value = np.ravel(worker_state['explainer'].expected_value)[-1]
+    error = float(np.abs(values.sum(axis=1) + base_value - raw).max()) if len(X) != 0 else 0.0
+    return start, stop, error
+
+class ShapEngine:
+    def __init__(self, model=model_file, output_dir=shap_dir, chunk_size=shap_chunk_size, n_jobs=None):
+        self.model = model
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+
+    def pool_size(self, num_tasks):
+        num_cpus = self.n_jobs or os.cpu_count()
+        num_workers = max(1, min(num_cpus, num_tasks))
+        # CatBoost threads of all the workers together should not exceed the cores
+        return num_workers, max(1, num_cpus // num_workers)
+
+    def load_model(self):
+        # Read before the output directory is cleared, a model path inside it would be removed with the old outputs
+        if isinstance(self.model, str):
+            model = CatBoostClassifier()
+            model.load_model(self.model)
+            return model
+        # The best estimator is accepted as the search object or a fitted CatBoost model
+        return getattr(self.model, 'best_estimator_', self.model)
+
+    def save_model(self, model):
+        # The workers load the model from a file
+        path = os.path.join(self.output_dir, model_file)
+        model.save_model(path)
+        return path
+
+    def write_inputs(self, X):
+        if os.path.exists(self.output_dir):
+            shutil.rmtree(self.output_dir)
+        os.makedirs(self.output_dir)
+        columns = [str(column) for column in X.columns]
+        eids = X.index.to_numpy(dtype=np.int64) if X.index.name == 'eid' else np.arange(len(X), dtype=np.int64)
+
+        # The cohort is written once as float32, every worker maps the rows of its chunks
+        np.save(os.path.join(self.output_dir, 'X.npy'), np.ascontiguousarray(X.to_numpy(dtype=np.float32)))
+        np.save(os.path.join(self.output_dir, 'eids.npy'), eids)
+        values = np.lib.format.open_memmap(os.path.join(self.output_dir, 'values.npy'), mode='w+',
+                                           dtype=np.float32, shape=(len(X), len(columns)))
+        del values
+        return columns
+
+    @traced('ShapEngine.explain', data_arg=1)
+    def explain(self, X):
+        start_time = time.perf_counter()
+        model = self.load_model()
+        columns = self.write_inputs(X)
+        model_path = self.save_model(model)
+        chunks = [(start, min(start + self.chunk_size, len(X))) for start in range(0, len(X), self.chunk_size)]
+        num_workers, thread_count = self.pool_size(len(chunks))
+        logging.info(f"Explaining {len(X)} participants in {len(chunks)} chunks "
+                     f"with {num_workers} workers of {thread_count} threads")
+
+        max_error = 0.0
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                                 initargs=(model_path, self.output_dir, thread_count)) as executor:
+            futures = [executor.submit(explain_chunk, start, stop) for start, stop in chunks]
+            for done, future in enumerate(as_completed(futures), 1):
+                start, stop, error = future.result()
+                max_error = max(max_error, error)
+                logging.debug(f"Explained rows {start}-{stop} ({done}/{len(chunks)} chunks)")
+        if max_error > additivity_tolerance:
+            logging.warning(f"The SHAP values of some participants do not add up to their raw prediction, "
+                            f"max additivity error {max_error:.2e} is above {additivity_tolerance:.0e}")
+
+        base_value = float(np.ravel(shap.TreeExplainer(model).expected_value)[-1])
+        with open(os.path.join(self.output_dir, shap_meta), 'w') as f:
+            json.dump({'columns': columns, 'base_value': base_value, 'num_rows': len(X),
+                       'max_additivity_error': max_error}, f, indent=4)
+        # X.npy is only the workers' input, the values are kept with the eids they belong to
+        os.remove(os.path.join(self.output_dir, 'X.npy'))
+
+        logging.info(f"Explained {len(X)} participants in {time.perf_counter() - start_time:.2f}s, "
+                     f"max additivity error {max_error:.2e}")
+        return ShapValues(self.output_dir)
+
+class ShapValues:
+    def __init__(self, output_dir=shap_dir):
+        self.output_dir = output_dir
+        with open(os.path.join(output_dir, shap_meta), 'r') as f:
+            meta = json.load(f)
+        self.columns = meta['columns']
+        self.base_value = meta['base_value']
+        self.values = np.load(os.path.join(output_dir, 'values.npy'), mmap_mode='r')
+        self.eids = np.load(os.path.join(output_dir, 'eids.npy'))
+
+    def rows(self, eids):
+        positions = pd.Index(self.eids).get_indexer(eids)
+        if (positions == -1).any():
+            raise KeyError(f"{int((positions == -1).sum())} eids were not explained")
+        return pd.DataFrame(np.asarray(self.values[positions]), index=pd.Index(eids, name='eid'), columns=self.columns)
+
+    def importance(self, chunk_size=summary_chunk_size):
+        # Sums are accumulated in float64 over chunks of the memory mapped values
+        num_columns = len(self.columns)
+        abs_sum = np.zeros(num_columns)
+        total = np.zeros(num_columns)
+        squares = np.zeros(num_columns)
+        positive = np.zeros(num_columns)
+        max_abs = np.zeros(num_columns)
+        num_rows = len(self.values)
+        for start in range(0, num_rows, chunk_size):
+            chunk = np.asarray(self.values[start:start + chunk_size], dtype=np.float64)
+            abs_sum += np.abs(chunk).sum(axis=0)
+            total += chunk.sum(axis=0)
+            squares += (chunk ** 2).sum(axis=0)
+            positive += (chunk > 0).sum(axis=0)
+            max_abs = np.maximum(max_abs, np.abs(chunk).max(axis=0, initial=0))
+
+        num_rows = max(num_rows, 1)
+        mean = total / num_rows
+        summary = pd.DataFrame({
+            'mean_abs_shap': abs_sum / num_rows,
+            'mean_shap': mean,
+            'std_shap': np.sqrt(np.maximum(squares / num_rows - mean ** 2, 0)),
+            'max_abs_shap': max_abs,
+            'positive_fraction': positive / num_rows,
+        }, index=pd.Index(self.columns, name='feature'))
+        return summary.sort_values('mean_abs_shap', ascending=False)
+
+def main():
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Explain the cohort with the exported model in parallel chunks")
+    parser.add_argument('--model', default=model_file)
+    parser.add_argument('--output-dir', default=shap_dir)
+    parser.add_argument('--chunk-size', type=int, default=shap_chunk_size)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    # The same cohort and dropped columns the model was searched on
+    cohort = load_cohort()
+    cohort.split_x_y()
+
+    shap_values = ShapEngine(args.model, args.output_dir, args.chunk_size, args.n_jobs).explain(cohort.X)
+    summary = shap_values.importance()
+    summary.to_csv(os.path.join(args.output_dir, 'importance.csv'))
+    logging.info(f"Top features by mean |SHAP|:\n{summary.head(20)}")
+    tracer.print_summary()
+
+if __name__ == "__main__":
+    main()
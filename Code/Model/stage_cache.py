@@ -0,0 +1,70 @@
+import pandas as pd
+import hashlib
+import inspect
+import logging
+import json
+import os
+
+default_cache_dir = 'cohort_cache'
+# Least recently used stage outputs are evicted once the cache grows past this size
+default_max_bytes = 2 * 1024 ** 3
+
+def fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def code_version(*funcs):
+    return fingerprint(*[inspect.getsource(func) for func in funcs])
+
+class StageCache():
+    def __init__(self, cache_dir=default_cache_dir, max_bytes=default_max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.parquet')
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            df = pd.read_parquet(path)
+        except Exception as ee:
+            logging.warning(f"Dropping unreadable cache entry {path} - {ee}")
+            os.remove(path)
+            return None
+        # The modification time doubles as the last use time for the LRU eviction
+        os.utime(path)
+        return df
+
+    def put(self, key, df):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        df.to_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.evict(keep=path)
+
+    def entries(self):
+        if not os.path.exists(self.cache_dir):
+            return []
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.parquet')]
+        return sorted((os.path.getmtime(path), os.path.getsize(path), path) for path in paths)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            logging.info(f"Evicting cache entry {path}")
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
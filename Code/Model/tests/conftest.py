@@ -0,0 +1,5 @@
+import sys
+import os
+
+# The model modules import each other by name, as when they are run from the Model directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
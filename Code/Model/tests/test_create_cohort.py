@@ -0,0 +1,60 @@
+import pandas as pd
+import numpy as np
+import pytest
+
+from create_cohort import Cohort
+from utils import feature_to_code
+
+endo_diag_col = '132123-0.0'
+endo_date_col = '132122-0.0'
+
+# The row-wise implementations the vectorised columns replaced
+def rowwise_estrogen_exposure(df):
+    menarche_age_code = feature_to_code("menarche")
+    menopause_age_code = feature_to_code("Age at menopause")
+
+    def calc_estrogen_exposure(row):
+        answer_not_known = [-1, 3]
+        if pd.isna(row[menarche_age_code]) or pd.isna(row[menopause_age_code]):
+            return np.nan
+        elif (row[menarche_age_code] in answer_not_known) or (row[menopause_age_code] in answer_not_known):
+            return np.nan
+        elif row[menopause_age_code] > row[menarche_age_code]:
+            return row[menopause_age_code] - row[menarche_age_code]
+        else:
+            return np.nan
+
+    return df.apply(calc_estrogen_exposure, axis=1)
+
+def rowwise_labels(df):
+    return df[endo_diag_col].isna().astype(int).apply(lambda x: 0 if x else 1)
+
+@pytest.fixture
+def cohort_df():
+    rng = np.random.default_rng(0)
+    answers = [np.nan, -1, -3, 3, 10, 12, 13, 14, 45, 50, 52]
+    menarche = list(rng.choice(answers, 500)) + [np.nan, -1, -3, 13, 13, 50, 13]
+    menopause = list(rng.choice(answers, 500)) + [50, 50, 50, -1, -3, 13, 13]
+    num_rows = len(menarche)
+    return pd.DataFrame({
+        feature_to_code("menarche"): menarche,
+        feature_to_code("Age at menopause"): menopause,
+        endo_diag_col: np.where(rng.random(num_rows) < 0.3, rng.integers(1, 5, num_rows), np.nan),
+        endo_date_col: np.nan,
+    }, index=pd.Index(np.arange(1000000, 1000000 + num_rows), name='eid'))
+
+def test_estrogen_exposure_matches_rowwise(cohort_df):
+    expected = rowwise_estrogen_exposure(cohort_df)
+    cohort = Cohort(df=cohort_df.copy())
+    cohort.add_estrogen_exposure_col()
+
+    pd.testing.assert_series_equal(cohort.df['estrogen_exposure'], expected, check_names=False)
+    assert expected.isna().any() and expected.notna().any()
+
+def test_labels_match_rowwise(cohort_df):
+    expected = rowwise_labels(cohort_df)
+    cohort = Cohort(df=cohort_df.copy())
+    cohort.create_labels()
+
+    pd.testing.assert_series_equal(cohort.df['has_endo'], expected, check_names=False)
+    assert endo_diag_col not in cohort.df.columns and endo_date_col not in cohort.df.columns
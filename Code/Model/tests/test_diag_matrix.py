@@ -0,0 +1,23 @@
+import pandas as pd
+
+from diag_matrix import DiagMatrixBuilder
+
+def test_codes_without_a_chapter_are_only_counted_per_code(tmp_path):
+    diag_path = tmp_path / 'hesin_diag.txt'
+    pd.DataFrame({
+        'eid': [1000001, 1000001, 1000002, 1000002, 1000003],
+        'diag_icd10': ['N800', 'A0', '0ZZ', 'N801', 'Z99'],
+    }).to_csv(diag_path, sep='\t', index=False)
+    builder = DiagMatrixBuilder(str(diag_path))
+
+    code3 = builder.load('code3')
+    code3_counts = pd.DataFrame(code3.matrix.toarray(), index=code3.eids, columns=code3.columns)
+    assert code3_counts.loc[1000001, 'icd10_A0'] == 1
+    assert code3_counts.loc[1000002, 'icd10_0ZZ'] == 1
+
+    chapter = builder.load('chapter')
+    chapter_counts = pd.DataFrame(chapter.matrix.toarray(), index=chapter.eids, columns=chapter.columns)
+    assert chapter_counts.loc[1000001].sum() == 1
+    assert chapter_counts.loc[1000002].sum() == 1
+    assert chapter_counts.loc[1000003, 'diag_chapter_XXI'] == 1
+    assert chapter_counts['diag_chapter_XXI'].sum() == 1
@@ -0,0 +1,40 @@
+import numpy as np
+import time
+
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+
+from model_selection import ModelSelector
+
+class SlowClassifier(ClassifierMixin, BaseEstimator):
+    def __init__(self, seconds=5):
+        self.seconds = seconds
+
+    def fit(self, X, y):
+        time.sleep(self.seconds)
+        return self
+
+    def predict(self, X):
+        return np.zeros(len(X), dtype=int)
+
+def make_data(num_rows=200, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(num_rows, 4))
+    y = (X[:, 0] + rng.normal(scale=0.5, size=num_rows) > 0).astype(int)
+    return X[:150], y[:150], X[150:], y[150:]
+
+def test_timeout_applies_next_to_models_without_one():
+    selector = ModelSelector()
+    # Slow overruns its timeout but finishes while the untimed Slower model is still fitting
+    selector.models = {
+        'Slow': SlowClassifier(seconds=4),
+        'Slower': SlowClassifier(seconds=8),
+        'Logistic Regression': LogisticRegression(),
+        'Decision Tree': DecisionTreeClassifier(),
+    }
+    selector.train_models(*make_data(), parallel=True, n_jobs=4, timeout={'Slow': 1})
+
+    assert selector.timed_out == ['Slow']
+    assert 'Slow' not in selector.results
+    assert set(selector.results) == {'Slower', 'Logistic Regression', 'Decision Tree'}
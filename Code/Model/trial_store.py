@@ -0,0 +1,57 @@
+import pandas as pd
+import hashlib
+import logging
+import json
+import os
+
+def dataset_fingerprint(X, y):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(column) for column in X.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(X, index=True).to_numpy().tobytes())
+    digest.update(pd.util.hash_pandas_object(y, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def trial_key(params, fold, settings):
+    return json.dumps({'params': params, 'fold': fold, **settings}, sort_keys=True, default=str)
+
+class TrialStore:
+    # Append only JSONL, every finished fit is one line so an interrupted search loses at most the running fits
+    def __init__(self, path):
+        self.path = path
+        self.trials = {}
+        self.ends_with_newline = True
+        self.load()
+
+    def load(self):
+        self.trials = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != 0:
+                f.seek(-1, os.SEEK_END)
+                self.ends_with_newline = f.read(1) == b'\n'
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    trial = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut if the machine was preempted while writing it
+                    logging.warning(f"Skipping a broken line of {self.path}")
+                    continue
+                self.trials[trial['key']] = trial
+        logging.info(f"Loaded {len(self.trials)} finished trials from {self.path}")
+
+    def get(self, key):
+        return self.trials.get(key)
+
+    def record(self, key, trial):
+        trial = {'key': key, **trial}
+        with open(self.path, 'a') as f:
+            if not self.ends_with_newline:
+                f.write('\n')
+                self.ends_with_newline = True
+            f.write(json.dumps(trial, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.trials[key] = trial
@@ -2,70 +2,190 @@ import pandas as pd
 import logging
 import pickle
 import sys
+import os
+import re
 
-sys.path.insert('..')
+FEATURE_NAME_COL = "Feature Name"
+CODE_NUMBER_COL  = "UKB Number"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s]:[%(module)-15s:%(lineno)3d]:[%(levelname)-8s] - %(message)s",
-)
+dataset_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Dataset')
+features_pickle_file = os.path.join(dataset_dir, 'features_data.csv.pkl')
 
-# When importing utils.py from py script we cannot use sns and plt
-try:
-    get_ipython()
-    import seaborn as sns
-    import matplotlib.pyplot as plt
-except:
-    logging.warning("Running in terminal, cannot import sns and plt")
+def setup_logging(level=logging.INFO):
+    logging.basicConfig(
+        level=level,
+        format="[%(asctime)s]:[%(module)-15s:%(lineno)3d]:[%(levelname)-8s] - %(message)s",
+    )
 
+class FeaturesCatalog:
+    def __init__(self, path=features_pickle_file):
+        self.path = path
+        self.features_data = None
+        self.code_to_name_index = {}
+        self.name_to_code_index = {}
+        self.trigram_index = {}
+        self.feature_to_code_cache = {}
 
-FEATURE_NAME_COL = "Feature Name"
-CODE_NUMBER_COL  = "UKB Number"
+    @property
+    def data(self):
+        self.ensure_loaded()
+        return self.features_data
 
-utils_features_data = None
+    def ensure_loaded(self):
+        # Loaded on the first lookup, importing utils should not touch the disk
+        if self.features_data is None:
+            self.load()
 
-def init():
-    global utils_features_data
-    features_pickle_file = "Dataset/features_data.csv.pkl"
+    def load(self):
+        with open(self.path, 'rb') as f:
+            self.features_data = pickle.load(f)
+        self.build_indexes()
+        logging.debug("Data initiated")
+
+    def build_indexes(self):
+        self.code_to_name_index = {}
+        self.name_to_code_index = {}
+        self.trigram_index = {}
+        self.feature_to_code_cache = {}
+
+        names = self.features_data[FEATURE_NAME_COL].tolist()
+        codes = self.features_data[CODE_NUMBER_COL].tolist()
+        for position, (name, code) in enumerate(zip(names, codes)):
+            # Some codes are listed twice, like the lookups before we keep the first row
+            self.code_to_name_index.setdefault(int(code), name)
+            self.name_to_code_index.setdefault(name.strip().lower(), code)
+            lower_name = name.lower()
+            for i in range(len(lower_name) - 2):
+                self.trigram_index.setdefault(lower_name[i:i + 3], set()).add(position)
+
+    def search_position(self, feature):
+        names = self.data[FEATURE_NAME_COL].tolist()
+        query = feature.lower()
+        positions = range(len(names))
+        # Plain text queries only need to check the names that share all of their trigrams
+        if len(query) >= 3 and re.escape(query) == query:
+            candidates = set(positions)
+            for i in range(len(query) - 2):
+                candidates &= self.trigram_index.get(query[i:i + 3], set())
+            positions = sorted(candidates)
+
+        pattern = re.compile(query, flags=re.IGNORECASE)
+        for position in positions:
+            if pattern.search(names[position]):
+                return position
+        raise IndexError(f"No feature matches {feature}")
+
+    def code_to_name(self, code):
+        self.ensure_loaded()
+        return self.code_to_name_index[code]
+
+    def codes_to_names(self, codes):
+        self.ensure_loaded()
+        return pd.Series(codes).map(self.code_to_name_index)
+
+    def name_to_code(self, name):
+        self.ensure_loaded()
+        return self.name_to_code_index[name.strip().lower()]
+
+    def feature_to_code(self, feature):
+        self.ensure_loaded()
+        if feature not in self.feature_to_code_cache:
+            position = self.search_position(feature)
+            self.feature_to_code_cache[feature] = self.features_data[CODE_NUMBER_COL].values[position]
+        return self.feature_to_code_cache[feature]
 
-    with open(features_pickle_file, 'rb') as f:
-        utils_features_data = pickle.load(f)
-    logging.debug("Data initiated")
+    def rename(self, old_name, new_name):
+        self.data[FEATURE_NAME_COL] = self.data[FEATURE_NAME_COL].replace({old_name: new_name})
+        self.build_indexes()
+
+features_catalog = FeaturesCatalog()
+
+def init():
+    features_catalog.load()
 
 def code_to_feature(code):
     try:
         if not code.split('-')[0].isnumeric():
             return code
         code = int(code.split('-')[0])
-        result = utils_features_data.loc[utils_features_data[CODE_NUMBER_COL] == code][FEATURE_NAME_COL].values[0]
-        return result
+        return features_catalog.code_to_name(code)
     except Exception as e:
         logging.error(f"Code number does not exist - {e}")
         raise e
 
+def codes_to_features(codes):
+    codes = pd.Index(codes)
+    base_codes = codes.astype(str).str.split('-').str[0]
+    is_code = base_codes.str.isnumeric()
+    names = features_catalog.codes_to_names(base_codes[is_code].astype(int))
+    if names.isna().any():
+        missing = list(base_codes[is_code][names.isna().to_numpy()])
+        logging.error(f"Code numbers do not exist - {missing}")
+        raise KeyError(missing)
+    result = codes.to_numpy(dtype=object, copy=True)
+    result[is_code] = names.to_numpy()
+    return pd.Index(result, name=codes.name)
+
 def feature_to_code(feature):
     try:
-        feat_values = utils_features_data.loc[utils_features_data[FEATURE_NAME_COL].str.contains(feature.lower(), case=False)]
-        result = f"{feat_values[CODE_NUMBER_COL].values[0]}-0.0"
-        return result
+        return f"{features_catalog.feature_to_code(feature)}-0.0"
     except Exception as e:
         logging.error("Feature name does not exist")
         raise e
 
+def features_to_codes(features):
+    return [feature_to_code(feature) for feature in features]
+
+def name_to_code(name):
+    return f"{features_catalog.name_to_code(name)}-0.0"
+
 def change_feature_name(old_name, new_name, is_value_code=False):
     try:
         if is_value_code:
             old_name = code_to_feature(old_name)
-        if old_name not in utils_features_data[FEATURE_NAME_COL].values:
-            logging.debug(utils_features_data[FEATURE_NAME_COL].values)
+        if old_name not in features_catalog.data[FEATURE_NAME_COL].values:
+            logging.debug(features_catalog.data[FEATURE_NAME_COL].values)
             raise Exception(f"Feature {old_name} does not exist")
-        utils_features_data[FEATURE_NAME_COL] = utils_features_data[FEATURE_NAME_COL].replace({old_name: new_name})
+        features_catalog.rename(old_name, new_name)
         logging.info(f"Renamed feature: {old_name} -> {new_name}")
     except Exception as e:
         logging.error(f"Got an error - {e}")
 
+def columnar_store():
+    # The Parquet store is written and read by the Dataset scripts, imported on the first read so importing utils
+    # does not load pyarrow.parquet. Appended, the Model modules keep precedence over the Dataset ones
+    if dataset_dir not in sys.path:
+        sys.path.append(dataset_dir)
+    import columnar_store
+    return columnar_store
+
+def has_fresh_parquet(path):
+    return columnar_store().has_fresh_parquet(path)
+
+def read_table(path, columns=None, eids=None, **csv_kwargs):
+    # Prefer the Parquet store written by `parse_database.py convert`, it only reads the requested columns and
+    # skips the row groups whose eid range has none of the requested participants
+    store = columnar_store()
+    if store.has_fresh_parquet(path):
+        return store.read_parquet(path, columns, eids)
+
+    df = pd.read_csv(path, usecols=columns, **csv_kwargs)
+    if eids is not None:
+        df = df[df['eid'].isin(eids)]
+    return df
+
+def iter_table(path, columns, chunk_size, **csv_kwargs):
+    store = columnar_store()
+    if store.has_fresh_parquet(path):
+        yield from store.iter_parquet(path, columns, chunk_size)
+        return
+
+    with pd.read_csv(path, usecols=columns, chunksize=chunk_size, **csv_kwargs) as reader:
+        for chunk in reader:
+            yield chunk
+
 def print_features(with_code=False):
-    for _, row in utils_features_data.iterrows():
+    for _, row in features_catalog.data.iterrows():
         code = f"{row[CODE_NUMBER_COL]} - " if with_code else ''
         logging.info(f"{code}{row[FEATURE_NAME_COL]} ")
 
@@ -77,7 +197,8 @@ def left_align(df):
     return left_aligned_df
 
 def get_null_precentages(df):
-    return pd.DataFrame(df.isnull().mean().round(4).mul(100).sort_values(ascending=False).rename(code_to_feature))
+    null_precentages = df.isnull().mean().round(4).mul(100).sort_values(ascending=False)
+    return pd.DataFrame(null_precentages.set_axis(codes_to_features(null_precentages.index)))
 
 def plot_one_hot_columns(df, title, xlabel, ylabel):
     def calculate_stats(df):
@@ -98,7 +219,10 @@ def plot_one_hot_columns(df, title, xlabel, ylabel):
     # When importing utils.py from py script we cannot use sns and plt
     try:
         get_ipython()
+        import seaborn as sns
+        import matplotlib.pyplot as plt
     except:
+        logging.warning("Running in terminal, cannot import sns and plt")
         return
 
     # Calculate stats
@@ -130,6 +254,4 @@ def plot_one_hot_columns(df, title, xlabel, ylabel):
         plt.text(i, zeros_count + ones_count/2, f'{ones_pct:.1f}%', ha='center', va='center')
 
     plt.tight_layout()
-    plt.show()
-
-init()
\ No newline at end of file
+    plt.show()
\ No newline at end of file